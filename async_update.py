@@ -0,0 +1,156 @@
+""" 基于asyncio的更新程序，可以嵌入其它asyncio服务中运行。
+网络访问与合并在线程池中执行，多个更新包并发下载，同时按版本顺序合并已下载的更新包；
+支持取消及按阶段设置超时，取消或超时时下载与合并在下一个数据块或文件处停止，已下载的部分保留用于续传。
+:author: 闻煜
+:time: 2026/10/18
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import events
+from logger import log
+from update import Update
+
+
+CHECK_PHASE = 'check'  # 获取更新列表、规划更新路径
+FETCH_PHASE = 'fetch'  # 下载一个更新包
+PATCH_PHASE = 'patch'  # 合并一个更新包
+FETCH_WORKERS = 2      # 默认并发下载的更新包数量
+
+
+def main() -> None:
+    """ 主函数, 程序从该函数运行 """
+
+    # 测试AsyncUpdate, 检查更新阶段超时30秒，每个更新包下载超时600秒
+    update = AsyncUpdate(timeouts={CHECK_PHASE: 30, FETCH_PHASE: 600})
+    print('update version list: ', asyncio.run(update.getUpdateVersions()))
+    asyncio.run(update.run())
+
+    return
+
+
+class UpdateError(Exception):
+    """ 更新失败，exitCode与写入配置文件的退出码相同 """
+
+    def __init__(self, exit_code: int) -> None:
+        """ 构造函数
+
+        :param exit_code: 退出码
+        """
+
+        super(UpdateError, self).__init__('update failed, exit code: {}'.format(exit_code))
+        self.exitCode = exit_code
+
+        return
+
+
+class AsyncUpdate:
+    """ asyncio更新程序类，与Update提供相同的getUpdateVersions、run方法 """
+
+    def __init__(self, config_path: str = 'update.ini', update_events: events.UpdateEvents = None,
+                 timeouts: dict = None, fetch_workers: int = FETCH_WORKERS) -> None:
+        """ 构造函数，初始化变量信息
+
+        :param config_path: 配置文件路径
+        :param update_events: 更新事件对象，默认为events.UPDATE_EVENTS
+        :param timeouts: 各阶段超时时间(秒), eg: {'check': 30, 'fetch': 600, 'patch': 300}，未指定的阶段不限时
+        :param fetch_workers: 并发下载的更新包数量
+        """
+
+        self.update = Update(config_path, update_events)
+        self.config = self.update.config
+        self.timeouts = dict(timeouts or {})
+        self.fetchWorkers = fetch_workers
+
+        return
+
+    async def getUpdateVersions(self) -> list:
+        """ 获取更新列表
+
+        :return: 返回更新列表
+        """
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            return await self.__call(CHECK_PHASE, executor, self.update.getUpdateVersions)
+
+    async def run(self) -> None:
+        """ 执行更新过程，任务被取消或阶段超时时停止更新并删除暂存目录，之后抛出CancelledError或TimeoutError；
+        更新失败时抛出UpdateError。
+        """
+
+        self.update.cancelEvent.clear()
+        with ThreadPoolExecutor(max_workers=self.fetchWorkers) as fetcher, \
+                ThreadPoolExecutor(max_workers=1) as patcher:
+            update_plan = await self.__call(CHECK_PHASE, patcher, self.update.prepareUpdate)
+            if len(update_plan) == 0:
+                return
+
+            # 并发下载全部更新包，同时按版本顺序合并已下载完成的更新包
+            slots = asyncio.Semaphore(self.fetchWorkers)
+            fetches = [asyncio.ensure_future(self.__fetch(fetcher, slots, step)) for step in update_plan]
+            try:
+                for step, fetching in zip(update_plan, fetches):
+                    await fetching
+                    await self.__call(PATCH_PHASE, patcher, self.update.patchStep, step)
+            except BaseException:
+                self.update.cancel()
+                for fetching in fetches:
+                    fetching.cancel()
+                await asyncio.gather(*fetches, return_exceptions=True)
+                await asyncio.shield(asyncio.get_running_loop().run_in_executor(patcher, self.update.abortUpdate))
+                raise
+
+            await self.__call(None, patcher, self.update.finishUpdate, update_plan)
+
+        return
+
+    async def __fetch(self, executor: ThreadPoolExecutor, slots: asyncio.Semaphore, step: dict) -> None:
+        """ 下载一个更新包，超时时间从开始下载时计算，不包含等待其它更新包下载的时间
+
+        :param executor: 下载线程池
+        :param slots: 并发下载数量限制
+        :param step: 更新步骤
+        """
+
+        async with slots:
+            await self.__call(FETCH_PHASE, executor, self.update.fetchStep, step)
+
+        return
+
+    async def __call(self, phase: str, executor: ThreadPoolExecutor, func, *args):
+        """ 在线程池中执行阶段任务，阶段超时或任务被取消时通知Update停止，并等待线程到达取消点后再返回，
+        保证返回后不再有线程修改程序目录。
+
+        :param phase: 阶段名称，为None时不限时
+        :param executor: 线程池
+        :param func: 阶段任务
+        :param args: 任务参数
+        :return: 任务返回值
+        """
+
+        future = asyncio.get_running_loop().run_in_executor(executor, self.__invoke, func, *args)
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), self.timeouts.get(phase))
+        except (asyncio.CancelledError, asyncio.TimeoutError) as e:
+            if isinstance(e, asyncio.TimeoutError):
+                log('更新阶段{}超时({}秒)，正在停止更新.'.format(phase, self.timeouts.get(phase)))
+            self.update.cancel()
+            await asyncio.gather(future, return_exceptions=True)
+            raise
+
+    @staticmethod
+    def __invoke(func, *args):
+        """ 在线程中执行任务，将Update中的sys.exit转换为UpdateError，避免停止事件循环
+
+        :param func: 任务
+        :param args: 任务参数
+        :return: 任务返回值
+        """
+
+        try:
+            return func(*args)
+        except SystemExit as e:
+            raise UpdateError(e.code if isinstance(e.code, int) else 1)
+
+
+if __name__ == '__main__':
+    main()
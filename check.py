@@ -0,0 +1,200 @@
+""" 快速检查更新，只使用标准库访问索引文件，不加载Qt、bsdiff4、psutil、urllib3，
+应用程序每次启动时调用，确定需要更新时才加载完整的更新程序。
+:author: 闻煜
+:time: 2026/10/18
+"""
+import json
+import os
+import random
+import time
+import urllib.error
+import urllib.request
+from config import UpdaterConfigInfo
+import planner
+import util
+from logger import log
+
+
+# 发布目录索引文件名称，由vbuilder --Index生成
+INDEX_FILE = 'index.json'
+
+JITTERED = False  # 本进程是否已经随机等待过，快速检查与完整检查共用，每个进程只等待一次
+
+
+def main() -> None:
+    """ 主函数, 程序从该函数运行 """
+
+    # 测试check_update, 返回None表示需要由完整的更新程序检查
+    start = time.perf_counter()
+    print('update versions: ', check_update(UpdaterConfigInfo()))
+    print('elapsed: ', time.perf_counter() - start)
+
+    return
+
+
+def read_cache(config: UpdaterConfigInfo) -> dict:
+    """ 读取本地版本列表缓存
+
+    :param config: 更新程序配置信息
+    :return: 缓存信息，缓存不存在、无效或文件服务器地址已变化时返回None
+    """
+
+    if not os.path.exists(config.cachePath):
+        return None
+
+    try:
+        cache = util.read_json(config.cachePath)
+    except (OSError, ValueError):
+        return None
+
+    if not isinstance(cache, dict) or cache.get('url') != config.serverUrl:
+        return None
+
+    return cache
+
+
+def write_cache(config: UpdaterConfigInfo, source: str, etag: str, last_modified: str, versions: list,
+                index: dict) -> None:
+    """ 保存本地版本列表缓存
+
+    :param config: 更新程序配置信息
+    :param source: 请求的资源, INDEX_FILE或空字符串(目录页面)
+    :param etag: 服务器返回的ETag
+    :param last_modified: 服务器返回的Last-Modified
+    :param versions: 版本号列表
+    :param index: 索引文件内容，没有索引文件时为None
+    """
+
+    cache = {
+        'url': config.serverUrl,
+        'source': source,
+        'etag': etag,
+        'lastModified': last_modified,
+        'checkTime': time.time(),
+        'versions': versions,
+        'index': index
+    }
+
+    try:
+        util.save_json(cache, config.cachePath)
+    except OSError as e:
+        log('保存版本列表缓存失败: {}.'.format(e))
+
+    return
+
+
+def write_backoff(config: UpdaterConfigInfo, cache: dict, status: int, retry_after: str) -> None:
+    """ 记录退避状态至本地缓存，连续失败时退避时间加倍并加入随机抖动，
+    服务器返回Retry-After时不早于该时间再检查。快速检查与完整检查共用。
+
+    :param config: 更新程序配置信息
+    :param cache: 原本地缓存信息
+    :param status: 索引文件响应状态码
+    :param retry_after: 服务器返回的Retry-After，没有时为空字符串
+    """
+
+    cache = dict(cache) if cache is not None else {
+        'url': config.serverUrl, 'source': None, 'checkTime': 0, 'versions': [], 'index': None}
+    cache['failures'] = cache.get('failures', 0) + 1
+    delay = min(config.checkBackoffMax, config.checkBackoff * 2 ** (cache['failures'] - 1))
+    delay = random.uniform(delay / 2, delay)
+    if retry_after.isdigit():
+        delay = max(delay, int(retry_after))
+    cache['backoffUntil'] = time.time() + delay
+    log('文件服务器繁忙, code: {}, 第{}次失败, {:.0f}秒内不再检查更新.'.format(status, cache['failures'], delay))
+
+    try:
+        util.save_json(cache, config.cachePath)
+    except OSError as e:
+        log('保存版本列表缓存失败: {}.'.format(e))
+
+    return
+
+
+def check_jitter(config: UpdaterConfigInfo) -> None:
+    """ 检查更新前随机等待，避免大量客户端同时启动时集中访问文件服务器。
+    一次更新会多次检查(快速检查、获取更新列表、准备更新)，同一进程只在第一次访问文件服务器前等待。
+
+    :param config: 更新程序配置信息
+    """
+
+    global JITTERED
+    if config.checkJitter > 0 and not JITTERED:
+        time.sleep(random.uniform(0, config.checkJitter))
+    JITTERED = True
+
+    return
+
+
+def check_update(config: UpdaterConfigInfo) -> list:
+    """ 快速检查更新，返回需要更新的版本列表。
+    检查间隔内或退避期间使用本地缓存；否则对索引文件发送条件请求，304时使用本地缓存，200时解析并保存缓存，
+    429/5xx时记录退避状态并使用本地缓存。
+    没有索引文件、网络错误等无法快速确定的情况返回None，由完整的更新程序检查并处理错误。
+
+    :param config: 更新程序配置信息
+    :return: 需要更新的版本列表，从小到大排序；无法快速确定时返回None
+    """
+
+    cache = read_cache(config)
+    now = time.time()
+    if cache is not None and (0 <= now - cache['checkTime'] < config.checkInterval
+                              or now < cache.get('backoffUntil', 0)):
+        index = cache.get('index')
+        versions = cache.get('versions', [])
+    else:
+        # 随机等待，避免大量客户端同时启动时集中访问文件服务器，同一进程只等待一次
+        check_jitter(config)
+
+        request = urllib.request.Request(config.serverUrl + INDEX_FILE)
+        if cache is not None and cache['source'] == INDEX_FILE:
+            if cache.get('etag'):
+                request.add_header('If-None-Match', cache['etag'])
+            if cache.get('lastModified'):
+                request.add_header('If-Modified-Since', cache['lastModified'])
+
+        previous = {}
+        try:
+            with urllib.request.urlopen(request, timeout=config.connectTimeout) as response:
+                index = json.loads(response.read().decode('utf-8'))
+                headers = response.headers
+        except urllib.error.HTTPError as e:
+            if e.code == 429 or e.code >= 500:  # 文件服务器过载，退避期间不再访问，与完整检查一致
+                write_backoff(config, cache, e.code, e.headers.get('Retry-After', ''))
+                if cache is None:
+                    return []
+                index, versions = cache.get('index'), cache.get('versions', [])
+                return filter_versions(config, index, versions)
+            if e.code != 304 or cache is None:
+                return None
+            index, headers, previous = cache['index'], e.headers, cache  # 索引文件未变化，沿用缓存
+        except (OSError, ValueError):  # 网络错误、索引文件格式错误
+            return None
+
+        if not isinstance(index, dict) or not isinstance(index.get('versions'), list):
+            return None
+        versions = sorted([item['version'] for item in index['versions']], key=util.cmp_to_key(util.compare_version))
+        write_cache(config, INDEX_FILE, headers.get('ETag', previous.get('etag')),
+                    headers.get('Last-Modified', previous.get('lastModified')), versions, index)
+
+    return filter_versions(config, index, versions)
+
+
+def filter_versions(config: UpdaterConfigInfo, index: dict, versions: list) -> list:
+    """ 按灰度发布比例过滤版本，只保留比当前版本新的版本
+
+    :param config: 更新程序配置信息
+    :param index: 索引文件内容，没有索引文件时为None
+    :param versions: 版本号列表，从小到大排序
+    :return: 需要更新的版本列表
+    """
+
+    if index is not None:
+        allowed = set(item['version'] for item in planner.rollout_versions(index, config.version)[0])
+        versions = [version for version in versions if version in allowed]
+
+    return [version for version in versions if util.compare_version(version, config.version) == 1]
+
+
+if __name__ == '__main__':
+    main()
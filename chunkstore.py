@@ -0,0 +1,491 @@
+""" 内容寻址分块存储，基于内容定义分块(CDC)实现跨文件、跨版本的去重更新
+:author: 闻煜
+:time: 2026/10/18
+"""
+import hashlib
+import json
+import os
+import shutil
+from typing import Callable
+import util
+try:
+    import numpy
+except ImportError:  # 未安装numpy时逐字节计算分块边界
+    numpy = None
+
+
+# Gear滚动哈希表，由md5确定性生成，保证vbuilder与更新程序分块结果一致
+GEAR = [int.from_bytes(hashlib.md5(bytes([i])).digest()[:8], 'little') for i in range(256)]
+GEAR_ARRAY = numpy.array(GEAR, dtype=numpy.uint64) if numpy is not None else None
+
+MIN_CHUNK_SIZE = 16 * 1024            # 最小分块大小
+MAX_CHUNK_SIZE = 256 * 1024           # 最大分块大小
+CHUNK_MASK = ((1 << 16) - 1) << 48    # 分块边界掩码，平均分块大小约为MIN_CHUNK_SIZE + 64KB
+CHUNK_DIGEST = 'sha256'               # 分块及文件摘要算法
+CHUNK_MANIFEST = 'chunks.json'        # 分块描述文件名称
+FILE_INDEX = 'files.json'             # 分块存储目录中的文件分块索引, {文件摘要值: 分块列表}，重复构建时跳过未变化的文件
+SCAN_SIZE = 32 * 1024                 # 向量化计算分块边界时每次处理的字节数
+GEAR_WINDOW = 64                      # Gear哈希只与最近64字节有关
+
+
+def main() -> None:
+    """ 主函数, 程序从该函数运行 """
+
+    # 测试iter_chunks, 输出文件分块信息
+    for offset, size, digest in iter_chunks('./update.py'):
+        print(offset, size, digest)
+
+    return
+
+
+def cut_point(data: bytearray, length: int) -> int:
+    """ 使用Gear滚动哈希计算第一个分块边界，安装numpy时向量化计算，结果与逐字节计算一致。
+
+    :param data: 数据缓冲区
+    :param length: 缓冲区有效数据长度
+    :return: 第一个分块的大小
+    """
+    if length <= MIN_CHUNK_SIZE:
+        return length
+    if numpy is not None:
+        return cut_point_vector(data, length)
+
+    gear = GEAR
+    mask = CHUNK_MASK
+    h = 0
+    end = min(length, MAX_CHUNK_SIZE)
+    for i in range(MIN_CHUNK_SIZE, end):
+        h = ((h << 1) + gear[data[i]]) & 0xFFFFFFFFFFFFFFFF
+        if not h & mask:
+            return i + 1
+
+    return end
+
+
+def cut_point_vector(data: bytearray, length: int) -> int:
+    """ 使用numpy向量化计算第一个分块边界。
+    64位Gear哈希h[i] = sum(GEAR[data[i - k]] << k), k < 64，按窗口倍增的方式6次移位相加即可得到全部位置的哈希值；
+    每次处理SCAN_SIZE字节，并带上之前63字节的上下文，找到边界后不再计算之后的数据。
+
+    :param data: 数据缓冲区
+    :param length: 缓冲区有效数据长度，需要大于MIN_CHUNK_SIZE
+    :return: 第一个分块的大小
+    """
+    mask = numpy.uint64(CHUNK_MASK)
+    end = min(length, MAX_CHUNK_SIZE)
+    for pos in range(MIN_CHUNK_SIZE, end, SCAN_SIZE):
+        # 逐字节计算时哈希从MIN_CHUNK_SIZE处开始累计，之前的字节不参与计算
+        begin = max(MIN_CHUNK_SIZE, pos - GEAR_WINDOW + 1)
+        stop = min(end, pos + SCAN_SIZE)
+        h = GEAR_ARRAY[numpy.frombuffer(data, dtype=numpy.uint8, count=stop - begin, offset=begin)]
+        shift = 1
+        while shift < GEAR_WINDOW:
+            h[shift:] += h[:-shift] << numpy.uint64(shift)
+            shift *= 2
+        hits = numpy.flatnonzero((h[pos - begin:] & mask) == 0)
+        if hits.size:
+            return pos + int(hits[0]) + 1
+
+    return end
+
+
+def iter_chunks(file: str) -> tuple:
+    """ 对文件进行内容定义分块，内存占用不超过一个读取缓冲区与最大分块大小之和。
+
+    :param file: 文件路径
+    :return: 生成器，依次生成(偏移, 大小, 摘要值)
+    """
+    buffer = bytearray()
+    offset = 0
+    eof = False
+    with open(file, 'rb') as fp:
+        while True:
+            # 保证缓冲区至少包含一个最大分块
+            while not eof and len(buffer) < MAX_CHUNK_SIZE:
+                data = fp.read(util.DIGEST_BUFFER_SIZE)
+                if not data:
+                    eof = True
+                buffer += data
+            if not buffer:
+                break
+
+            size = cut_point(buffer, len(buffer))
+            yield offset, size, hashlib.new(CHUNK_DIGEST, memoryview(buffer)[:size]).hexdigest()
+            del buffer[:size]
+            offset += size
+
+
+def chunk_file(path: str, digest: str) -> str:
+    """ 分块在存储目录中的相对路径, eg: ab/abcdef...
+
+    :param path: 存储目录
+    :param digest: 分块摘要值
+    :return: 分块文件路径
+    """
+    return os.path.join(path, digest[:2], digest)
+
+
+def walk_files(path: str, ignore: list) -> list:
+    """ 遍历目录下除忽略文件以外的全部文件
+
+    :param path: 目录路径
+    :param ignore: 忽略的文件或目录名称
+    :return: 以/分隔的相对路径列表，按路径排序
+    """
+    files = []
+    for root, dirs, names in os.walk(path):
+        dirs[:] = [item for item in dirs if item not in ignore]
+        for name in names:
+            if name in ignore:
+                continue
+            files.append(os.path.relpath(os.path.join(root, name), path).replace(os.sep, '/'))
+
+    return sorted(files)
+
+
+class ChunkBuilder:
+    """ 构造分块描述文件类
+    将新版本程序目录中的文件分块存入内容寻址的分块存储目录，相同分块只存储一份，
+    分块描述文件默认文件名称为chunks.json，格式描述如下：
+    ---------------------------------------->
+    {
+      "version": "3.0",
+      "chunkStore": "chunks/",
+      "digestAlgorithm": "sha256",
+      "files": [
+        {
+          "path": "sub/app.dll",
+          "size": 81920,
+          "digest": "9f86d081884c7d659a2feaa0c55ad015...",
+          "chunks": [["2c26b46b68ffc68ff99b453c1d304134...", 65536], ["fcde2b2edba56bf408601fb721fe9b5c...", 16384]]
+        }
+      ]
+    }
+    <----------------------------------------
+    其中chunkStore为分块存储目录相对文件服务器根目录的地址。
+    """
+
+    def __init__(self, right_path: str, patch_path: str, store_path: str, ignore: list = None) -> None:
+        """ 构造函数，初始化成员变量
+
+        :param right_path: 新版本程序目录
+        :param patch_path: 补丁目录，分块描述文件放置在该目录
+        :param store_path: 分块存储目录，一般位于文件服务器发布目录根部，多个版本共用
+        :param ignore: 忽略的文件或目录
+        """
+
+        self.rightPath = right_path
+        self.patchPath = patch_path
+        self.storePath = store_path
+        self.ignore = ignore or []
+        self.version = ''
+        self.files = []
+
+        # 分块存储目录相对发布目录(补丁目录上一级)的地址
+        publish_path = os.path.dirname(os.path.abspath(self.patchPath))
+        self.storeUrl = os.path.relpath(os.path.abspath(self.storePath), publish_path).replace(os.sep, '/') + '/'
+
+        return
+
+    def build(self) -> None:
+        """ 分块并写入分块存储目录，输出去重统计 """
+
+        stored = 0        # 新写入的分块数
+        reused = 0        # 已存在(去重)的分块数
+        stored_size = 0   # 新写入字节数
+        total_size = 0    # 文件总字节数
+        file_index = self.__read_file_index()
+        for path in walk_files(self.rightPath, self.ignore):
+            fp = os.path.join(self.rightPath, *path.split('/'))
+            file = {'path': path, 'size': util.get_file_size(fp),
+                    'digest': util.get_file_digest(fp, CHUNK_DIGEST), 'chunks': []}
+
+            # 之前构建过相同内容的文件且分块仍在存储目录中时，直接使用其分块列表，无需重新分块
+            chunks = file_index.get(file['digest'])
+            if chunks is not None and all(os.path.exists(chunk_file(self.storePath, digest)) for digest, _ in chunks):
+                file['chunks'] = chunks
+                reused += len(chunks)
+                total_size += file['size']
+                self.files.append(file)
+                continue
+
+            with open(fp, 'rb') as source:
+                for offset, size, digest in iter_chunks(fp):
+                    file['chunks'].append([digest, size])
+                    target = chunk_file(self.storePath, digest)
+                    if os.path.exists(target):
+                        reused += 1
+                        continue
+                    os.makedirs(os.path.dirname(target), exist_ok=True)
+                    source.seek(offset)
+                    with open(target + '.tmp', 'wb') as chunk:
+                        chunk.write(source.read(size))
+                    os.replace(target + '.tmp', target)
+                    stored += 1
+                    stored_size += size
+
+            total_size += file['size']
+            self.files.append(file)
+            file_index[file['digest']] = file['chunks']
+            print('chunked: ', path, len(file['chunks']))
+
+        util.save_json(file_index, os.path.join(self.storePath, FILE_INDEX))
+        print('chunks stored: {}, reused: {}, new bytes: {}/{}.'.format(stored, reused, stored_size, total_size))
+
+        return
+
+    def __read_file_index(self) -> dict:
+        """ 读取分块存储目录中的文件分块索引
+
+        :return: {文件摘要值: 分块列表}，不存在或无效时返回空字典
+        """
+
+        try:
+            file_index = util.read_json(os.path.join(self.storePath, FILE_INDEX))
+        except (OSError, ValueError):
+            return {}
+
+        return file_index if isinstance(file_index, dict) else {}
+
+    def write(self) -> None:
+        """ 将分块描述信息写入补丁目录chunks.json文件 """
+
+        manifest = {
+            'version': self.version,
+            'chunkStore': self.storeUrl,
+            'digestAlgorithm': CHUNK_DIGEST,
+            'files': self.files
+        }
+        os.makedirs(self.patchPath, exist_ok=True)
+        util.save_json(manifest, os.path.join(self.patchPath, CHUNK_MANIFEST))
+
+        return
+
+
+class ChunkUpdater:
+    """ 分块更新类，只下载本地程序目录及分块缓存中不存在的分块，然后重建文件 """
+
+    def __init__(self, http, server_url: str, program_path: str, cache_path: str, ignore: list,
+                 log: Callable[[str], None] = print, progress: Callable[[int], None] = None, limiter=None,
+                 manifest_path: str = None) -> None:
+        """ 构造函数，初始化成员变量
+
+        :param http: urllib3连接池
+        :param server_url: 文件服务器地址
+        :param program_path: 应用程序目录
+        :param cache_path: 分块缓存目录，中断后再次更新时复用已下载的分块
+        :param ignore: 忽略的文件或目录名称
+        :param log: 日志回调函数
+        :param progress: 进度回调函数，参数为0~100
+        :param limiter: 下载限速对象，为None时不限速
+        :param manifest_path: 本地保存的已安装版本分块描述文件路径，为None时不保存
+        """
+
+        self.http = http
+        self.serverUrl = server_url
+        self.programPath = program_path
+        self.cachePath = cache_path
+        self.ignore = ignore
+        self.log = log
+        self.progress = progress
+        self.limiter = limiter
+        self.manifestPath = manifest_path
+
+        return
+
+    def update(self, manifest_file: str, base_manifest_file: str = None) -> None:
+        """ 根据分块描述文件更新应用程序目录
+
+        :param manifest_file: 分块描述文件相对文件服务器根目录的路径
+        :param base_manifest_file: 已安装版本的分块描述文件路径，本地没有保存时从文件服务器获取，可以为None
+        """
+
+        manifest = self.__request_json(self.serverUrl + manifest_file)
+        changed, local_chunks = self.__download(manifest, base_manifest_file)
+
+        # 3）重建变化文件至临时文件，全部重建并校验后再替换，避免更新中断导致程序不完整
+        written = []
+        try:
+            for file in changed:
+                fp = os.path.join(self.programPath, *file['path'].split('/'))
+                written.append(fp + '.chunktmp')
+                self.__rebuild(file, fp + '.chunktmp', local_chunks)
+        except BaseException:
+            # 任一文件重建失败时删除已写入的临时文件，程序目录保持不变
+            for tmp in written:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+            raise
+        for file in changed:
+            fp = os.path.join(self.programPath, *file['path'].split('/'))
+            os.replace(fp + '.chunktmp', fp)
+
+        # 4）删除新版本中不存在的文件，并清理分块缓存
+        paths = set(file['path'] for file in manifest['files'])
+        for path in walk_files(self.programPath, self.ignore):
+            if path not in paths:
+                os.remove(os.path.join(self.programPath, *path.split('/')))
+        if os.path.exists(self.cachePath):
+            shutil.rmtree(self.cachePath)
+
+        # 5）保存新版本分块描述文件，下次更新时本地未变化的文件无需重新分块
+        if self.manifestPath is not None:
+            util.save_json(manifest, self.manifestPath)
+
+        return
+
+    def prefetch(self, manifest_file: str, base_manifest_file: str = None) -> None:
+        """ 只下载本地及缓存中不存在的分块至分块缓存目录，不修改应用程序目录，用于后台预下载
+
+        :param manifest_file: 分块描述文件相对文件服务器根目录的路径
+        :param base_manifest_file: 已安装版本的分块描述文件路径，可以为None
+        """
+
+        self.__download(self.__request_json(self.serverUrl + manifest_file), base_manifest_file)
+
+        return
+
+    def __download(self, manifest: dict, base_manifest_file: str = None) -> tuple:
+        """ 扫描本地文件并下载缺失的分块
+
+        :param manifest: 分块描述信息
+        :param base_manifest_file: 已安装版本的分块描述文件路径
+        :return: (变化文件列表, 本地分块{摘要值: (文件, 偏移)})
+        """
+
+        store_url = self.serverUrl + manifest['chunkStore']
+
+        # 1）扫描本地文件，内容未变化的文件无需处理
+        digests = {}  # 本地文件摘要值，每个文件只计算一次
+        changed = [file for file in manifest['files']
+                   if not self.__match(os.path.join(self.programPath, *file['path'].split('/')), file, digests)]
+
+        # 存在变化文件时收集本地可复用分块：大小与摘要值和新版本或已安装版本分块描述一致的文件直接使用描述中的分块，
+        # 只有与两者都不一致的文件(eg: 被修改的文件)才需要重新分块
+        local_chunks = {}  # 摘要值 -> (文件, 偏移)
+        if changed:
+            described = {file['path']: [file] for file in manifest['files']}
+            for file in self.__base_manifest(base_manifest_file).get('files', []):
+                described.setdefault(file['path'], []).append(file)
+            for path in walk_files(self.programPath, self.ignore):
+                fp = os.path.join(self.programPath, *path.split('/'))
+                file = next((item for item in described.get(path, []) if self.__match(fp, item, digests)), None)
+                if file is None:
+                    for offset, size, digest in iter_chunks(fp):
+                        local_chunks.setdefault(digest, (fp, offset))
+                    continue
+                offset = 0
+                for digest, size in file['chunks']:
+                    local_chunks.setdefault(digest, (fp, offset))
+                    offset += size
+
+        # 2）下载本地及缓存中都不存在的分块
+        missing = {}
+        for file in changed:
+            for digest, size in file['chunks']:
+                if digest not in local_chunks and not os.path.exists(chunk_file(self.cachePath, digest)):
+                    missing[digest] = size
+        self.log('分块更新: 变化文件{}个, 需下载分块{}个, 共{}字节.'.format(
+            len(changed), len(missing), sum(missing.values())))
+        for i, digest in enumerate(sorted(missing)):
+            self.__download_chunk(store_url, digest)
+            if self.progress is not None:
+                self.progress(int(100 * (i + 1) / len(missing)))
+
+        return changed, local_chunks
+
+    @staticmethod
+    def __match(fp: str, file: dict, digests: dict) -> bool:
+        """ 判断本地文件与分块描述中的文件大小及摘要值是否一致
+
+        :param fp: 本地文件路径
+        :param file: 分块描述中的文件信息
+        :param digests: 本地文件摘要值缓存, {文件路径: 摘要值}
+        :return: 是否一致
+        """
+
+        if not os.path.isfile(fp) or util.get_file_size(fp) != file['size']:
+            return False
+        if fp not in digests:
+            digests[fp] = util.get_file_digest(fp, CHUNK_DIGEST)
+
+        return digests[fp] == file['digest']
+
+    def __base_manifest(self, base_manifest_file: str = None) -> dict:
+        """ 获取已安装版本的分块描述信息，优先读取本地保存的分块描述文件，不存在时从文件服务器获取。
+        分块描述只在文件大小与摘要值一致时使用，本地文件被修改或分块描述已过期时不会使用错误的分块。
+
+        :param base_manifest_file: 已安装版本的分块描述文件路径
+        :return: 分块描述信息，获取失败时返回空字典
+        """
+
+        if self.manifestPath is not None and os.path.exists(self.manifestPath):
+            try:
+                return util.read_json(self.manifestPath)
+            except (OSError, ValueError):
+                pass
+
+        if base_manifest_file:
+            import urllib3.exceptions
+            try:
+                return self.__request_json(self.serverUrl + base_manifest_file)
+            except (urllib3.exceptions.HTTPError, OSError, ValueError) as e:
+                self.log('获取已安装版本分块描述失败: {}.'.format(e))
+
+        return {}
+
+    def __request_json(self, url: str) -> dict:
+        """ 请求json数据 """
+
+        response = self.http.request('GET', url)
+        if response.status != 200:
+            raise IOError('request {} error, code: {}'.format(url, response.status))
+
+        return json.loads(response.data.decode('utf-8'))
+
+    def __download_chunk(self, store_url: str, digest: str) -> None:
+        """ 下载分块至缓存目录并校验摘要值 """
+
+        url = store_url + digest[:2] + '/' + digest
+        response = self.http.request('GET', url)
+        if response.status != 200:
+            raise IOError('fetch chunk {} error, code: {}'.format(digest, response.status))
+        if self.limiter is not None:
+            self.limiter.consume(len(response.data))
+        if hashlib.new(CHUNK_DIGEST, response.data).hexdigest() != digest:
+            raise IOError('chunk {} digest mismatch'.format(digest))
+
+        target = chunk_file(self.cachePath, digest)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open(target + '.tmp', 'wb') as fp:
+            fp.write(response.data)
+        os.replace(target + '.tmp', target)
+
+        return
+
+    def __rebuild(self, file: dict, target: str, local_chunks: dict) -> None:
+        """ 使用本地分块与缓存分块重建文件，写入时同步计算摘要值校验 """
+
+        hasher = hashlib.new(CHUNK_DIGEST)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open(target, 'wb') as out:
+            for digest, size in file['chunks']:
+                if digest in local_chunks:
+                    source, offset = local_chunks[digest]
+                else:
+                    source, offset = chunk_file(self.cachePath, digest), 0
+                with open(source, 'rb') as fp:
+                    fp.seek(offset)
+                    data = fp.read(size)
+                hasher.update(data)
+                out.write(data)
+
+        if hasher.hexdigest() != file['digest']:
+            os.remove(target)
+            raise IOError('rebuild {} digest mismatch'.format(file['path']))
+
+        return
+
+
+if __name__ == '__main__':
+    main()
@@ -3,8 +3,10 @@
 :time: 2022/09/10
 """
 import configparser
+import contextlib
+import os
 import platform
-from PyQt5.QtCore import QObject, pyqtSignal
+import threading
 
 
 def main() -> None:
@@ -35,13 +37,48 @@ class UpdaterConfigInfo:
         path = .                           ; 应用程序目录
         patch_path = .\tmp                 ; 补丁(更新)目录
         ignore_files = update.exe:version  ; 忽略更新文件, 以:分割
+        log_path = ./log/update.log        ; 日志路径
+        log_max_size = 1048576             ; 单个日志文件最大字节数, 超过时轮转, 可选
+        log_backups = 3                    ; 保留的历史日志文件数量, 可选
 
         [server]
         ; 文件服务器地址, 末尾/不可省略
         url = http://localhost:1024/demoapp2/
+        connect_timeout = 5                ; 连接超时时间(秒), 可选
+        read_timeout = 30                  ; 读取超时时间(秒), 可选
+        retries = 3                        ; 请求失败重试次数, 可选
+        backoff_factor = 0.5               ; 重试退避因子(秒), 可选
+        check_interval = 0                 ; 最短检查更新间隔(秒), 间隔内直接使用本地缓存, 可选
+        check_jitter = 0                   ; 检查更新前随机等待的最长时间(秒), 可选
+        check_backoff = 60                 ; 服务器返回5xx/429后暂停检查的初始时间(秒), 每次失败加倍, 可选
+        check_backoff_max = 21600          ; 暂停检查的最长时间(秒), 可选
+        rate_limit = 0                     ; 下载限速(字节/秒), 0为不限速, 可选
+        rate_limit_hours = 08:00-18:00     ; 限速时间段, 以,分隔, 为空时全天限速, 可选
+        background_rate_limit = 0          ; 后台预下载限速(字节/秒), 0时与rate_limit相同, 可选
+
+        [update]
+        exitcode = 0
+        chunk_update = 0                   ; 是否启用分块更新, 可选
+        stream_merge = 1                   ; 是否直接从更新包中流式合并, 不解压至补丁目录, 为0时不校验合并结果且不单独下载完整文件, 可选
+        workers = 4                        ; 流式合并并发线程数, 0为CPU核数, 可选
+        staged_install = 0                 ; 是否启用分阶段安装, 可选
+        snapshot_path = ./snapshot         ; 分阶段安装上一版本快照目录, 可选
+        chunk_cache = ./chunk_cache        ; 分块缓存目录, 可选
+
+        [lan]
+        ; 局域网缓存, 整节可选
+        enabled = 0                        ; 是否启用局域网缓存
+        cache_url = http://10.0.0.5/app/   ; 局域网缓存服务器地址, 目录结构与文件服务器相同, 可选
+        discovery = 1                      ; 是否广播查询局域网内持有更新包的节点
+        broadcast = 255.255.255.255        ; 广播地址
+        port = 18026                       ; 节点UDP查询与HTTP下载端口
+        timeout = 1                        ; 查询及连接超时时间(秒)
+        store_path = ./lan_cache           ; 本机共享更新包的存储目录
+        store_size = 3                     ; 本机共享更新包的数量
         <-----------------------------------------------------
         默认忽略文件目录：'version', 'update_gui.exe', 'update.exe', 'update.ini',
-        'tmp', 'update.log', 'update', 'update_gui'.
+        'tmp', 'update.log', 'update', 'update_gui', 'update.cache', 'update.chunks', 'chunk_cache', 'snapshot',
+        'prefetch.pid', 'lan_cache'.
 
         :param config_file_path: 配置文件路径，默认为./update.ini
         """
@@ -49,25 +86,29 @@ class UpdaterConfigInfo:
         # 配置文件路径
         self.configFilePath = config_file_path
 
-        # 使用configparser处理ini文件
-        config = configparser.ConfigParser()
-        config.read(config_file_path)
-
-        # 读取配置文件，对变量初始化
-        self.programName = config.get('program', 'name')
-        self.application = config.get('program', 'application')
-        self.version = config.get('program', 'version')
-        self.programPath = config.get('program', 'path')
-        self.patchPath = config.get('program', 'patch_path')
-        self.ignoreFiles = config.get('program', 'ignore_files').split(':')
-        self.logPath = config.get('program', 'log_path')
-        self.serverUrl = config.get('server', 'url')
-        self.exitCode = config.get('update', 'exitCode')
+        # 内存中的配置，只在文件修改时间变化时重新读取，修改的配置批量写回
+        self.parser = None
+        self.mtime = None        # 已读取的配置文件修改时间(纳秒)
+        self.dirty = {}          # 未写回配置文件的修改, {(section, key): value}
+        self.batchDepth = 0      # batch嵌套层数，大于0时延迟写回
+        self.lock = threading.RLock()
 
         # 默认忽略配置文件和目录
         self.ignoreFilesDefault = ['version', 'update_gui.exe', 'update.exe', 'log',
-                                   'update.ini', 'tmp', 'update.log', 'update', 'update_gui']
-        self.ignoreFiles = self.ignoreFiles + self.ignoreFilesDefault
+                                   'update.ini', 'tmp', 'update.log', 'update', 'update_gui', 'update.cache',
+                                   'update.chunks', 'chunk_cache', 'snapshot', 'prefetch.pid', 'lan_cache']
+
+        # 读取配置文件，对变量初始化
+        self.refresh()
+
+        # 版本列表缓存文件，与配置文件放置在同一目录
+        self.cachePath = os.path.join(os.path.dirname(os.path.abspath(config_file_path)), 'update.cache')
+
+        # 已安装版本的分块描述文件，分块更新时本地未变化的文件据此获得分块，无需重新分块
+        self.chunkManifestPath = os.path.join(os.path.dirname(os.path.abspath(config_file_path)), 'update.chunks')
+
+        # 后台预下载进程号文件，前台更新时据此结束后台预下载
+        self.prefetchPidPath = os.path.join(os.path.dirname(os.path.abspath(config_file_path)), 'prefetch.pid')
 
         # 路径分隔符
         # 路径分隔符，根据不同系统平台适配不同分隔符
@@ -85,71 +126,187 @@ class UpdaterConfigInfo:
         return
 
     def writeConfigFile(self, section: str, key: str, val: str) -> bool:
-        """ 将信息写回配置文件
+        """ 修改配置信息并写回配置文件，值未变化时不写文件；在batch中调用时，batch结束后一次写回
 
         :param section: ini文件节
         :param key: ini文件key
         :param val: ini文件value
+        :return: 写入成功返回True
         """
 
-        # 使用configparser处理ini文件
-        config = configparser.ConfigParser()
-        config.read(self.configFilePath)
-
-        # 根据key-value设置
-        config[section][key] = val
-
-        # 将配置写入ini文件
-        try:
-            file = open(self.configFilePath, 'w')
-            config.write(file)
-        except OSError as reason:
-            # TODO 日志处理
-            print('error:' + reason)
-            return False
-        finally:
-            file.close()
-
-        # 刷新读取配置信息
-        self.refresh()
+        with self.lock:
+            self.refresh()
+            if self.parser.get(section, key, fallback=None) == val:
+                return True
+
+            self.parser[section][key] = val
+            self.dirty[(section, key)] = val
+            self.__load(self.parser)
+
+            if self.batchDepth > 0:
+                return True
+            return self.flush()
+
+    @contextlib.contextmanager
+    def batch(self):
+        """ 批量修改配置信息，with语句块内的writeConfigFile只修改内存，结束时一次写回配置文件
+        eg:
+        with config.batch():
+            config.writeConfigFile('program', 'version', '2.0')
+            config.writeConfigFile('update', 'exitCode', '0')
+        """
+
+        with self.lock:
+            self.batchDepth += 1
+            try:
+                yield self
+            finally:
+                self.batchDepth -= 1
+                if self.batchDepth == 0:
+                    self.flush()
+
+    def flush(self) -> bool:
+        """ 将修改的配置信息原子写回配置文件：先写入临时文件，再替换配置文件，写入中断时配置文件保持不变
+
+        :return: 写入成功返回True
+        """
+
+        with self.lock:
+            if not self.dirty:
+                return True
+
+            tmp_file = self.configFilePath + '.tmp'
+            try:
+                with open(tmp_file, 'w') as file:
+                    self.parser.write(file)
+                    file.flush()
+                    os.fsync(file.fileno())
+                os.replace(tmp_file, self.configFilePath)
+            except OSError as reason:
+                # TODO 日志处理
+                print('error: {}'.format(reason))
+                if os.path.exists(tmp_file):
+                    os.remove(tmp_file)
+                return False
+
+            self.dirty = {}
+            self.mtime = os.stat(self.configFilePath).st_mtime_ns
 
         return True
 
     def refresh(self) -> None:
-        """ 重新读取配置信息，更新状态 """
+        """ 重新读取配置信息，更新状态；配置文件修改时间未变化时直接使用内存中的配置 """
 
-        # 配置文件路径
-        self.configFilePath = self.configFilePath
+        with self.lock:
+            try:
+                mtime = os.stat(self.configFilePath).st_mtime_ns
+            except OSError:
+                mtime = None
+            if self.parser is not None and mtime == self.mtime:
+                return
 
-        # 使用configparser处理ini文件
-        config = configparser.ConfigParser()
-        config.read(self.configFilePath)
+            # 使用configparser处理ini文件
+            config = configparser.ConfigParser()
+            config.read(self.configFilePath)
+
+            # 配置文件被外部修改时，保留尚未写回的修改
+            for (section, key), val in self.dirty.items():
+                config[section][key] = val
+
+            self.__load(config)
+            self.parser = config
+            self.mtime = mtime
+
+        return
+
+    def __load(self, config: configparser.ConfigParser) -> None:
+        """ 根据配置信息对变量初始化
+
+        :param config: 已读取的配置信息
+        """
 
-        # 读取配置文件，对变量初始化
         self.programName = config.get('program', 'name')
         self.application = config.get('program', 'application')
         self.version = config.get('program', 'version')
         self.programPath = config.get('program', 'path')
         self.patchPath = config.get('program', 'patch_path')
-        self.ignoreFiles = config.get('program', 'ignore_files').split(':')
-        self.ignoreFiles = self.ignoreFiles + self.ignoreFilesDefault
+        self.ignoreFiles = config.get('program', 'ignore_files').split(':') + self.ignoreFilesDefault
         self.logPath = config.get('program', 'log_path')
+        self.logMaxSize = config.getint('program', 'log_max_size', fallback=1024 * 1024)
+        self.logBackups = config.getint('program', 'log_backups', fallback=3)
         self.serverUrl = config.get('server', 'url')
+        self.connectTimeout = config.getfloat('server', 'connect_timeout', fallback=5.0)
+        self.readTimeout = config.getfloat('server', 'read_timeout', fallback=30.0)
+        self.retries = config.getint('server', 'retries', fallback=3)
+        self.backoffFactor = config.getfloat('server', 'backoff_factor', fallback=0.5)
+        self.checkInterval = config.getfloat('server', 'check_interval', fallback=0)
+        self.checkJitter = config.getfloat('server', 'check_jitter', fallback=0)
+        self.checkBackoff = config.getfloat('server', 'check_backoff', fallback=60)
+        self.checkBackoffMax = config.getfloat('server', 'check_backoff_max', fallback=6 * 3600)
+        self.rateLimit = config.getfloat('server', 'rate_limit', fallback=0)
+        self.rateLimitHours = config.get('server', 'rate_limit_hours', fallback='')
+        self.backgroundRateLimit = config.getfloat('server', 'background_rate_limit', fallback=0)
         self.exitCode = config.get('update', 'exitCode')
+        self.chunkUpdate = config.getboolean('update', 'chunk_update', fallback=False)
+        self.streamMerge = config.getboolean('update', 'stream_merge', fallback=True)
+        self.workers = config.getint('update', 'workers', fallback=4) or os.cpu_count() or 1
+        self.stagedInstall = config.getboolean('update', 'staged_install', fallback=False)
+        self.snapshotPath = config.get('update', 'snapshot_path', fallback=os.path.join(
+            os.path.dirname(os.path.abspath(self.configFilePath)), 'snapshot'))
+        self.chunkCachePath = config.get('update', 'chunk_cache', fallback=os.path.join(
+            os.path.dirname(os.path.abspath(self.configFilePath)), 'chunk_cache'))
+        self.lanEnabled = config.getboolean('lan', 'enabled', fallback=False)
+        self.lanCacheUrl = config.get('lan', 'cache_url', fallback='')
+        self.lanDiscovery = config.getboolean('lan', 'discovery', fallback=True)
+        self.lanBroadcast = config.get('lan', 'broadcast', fallback='255.255.255.255')
+        self.lanPort = config.getint('lan', 'port', fallback=18026)
+        self.lanTimeout = config.getfloat('lan', 'timeout', fallback=1.0)
+        self.lanStorePath = config.get('lan', 'store_path', fallback=os.path.join(
+            os.path.dirname(os.path.abspath(self.configFilePath)), 'lan_cache'))
+        self.lanStoreSize = config.getint('lan', 'store_size', fallback=3)
+
+        return
+
+
+def create_update_signal():
+    """ 创建更新信号对象，在此导入PyQt5，无界面运行时不加载Qt
+
+    :return: 更新信号对象
+    """
+
+    from PyQt5.QtCore import QObject, pyqtSignal
+
+    class UpdateSignal(QObject):
+        """ 设置信号 """
+        currVersion = pyqtSignal(str)  # 当前版本信号
+        newVersion = pyqtSignal(str)   # 最新版本信号
+        completed = pyqtSignal(int)    # 更新完成信号
+        log = pyqtSignal(str)          # 日志信息信号
+        progress = pyqtSignal(int)     # 更新进度信号
+
+    return UpdateSignal()
+
+
+class LazyUpdateSignal:
+    """ 延迟创建的更新信号，首次访问信号时才创建UpdateSignal对象 """
+
+    def __init__(self) -> None:
+        """ 构造函数，信号对象在首次访问时创建 """
+
+        self.signal = None
 
         return
 
+    def __getattr__(self, name: str):
+        """ 首次访问信号时创建信号对象, eg: UPDATE_SIGNAL.log.emit('...') """
+
+        if self.signal is None:
+            self.signal = create_update_signal()
 
-class UpdateSignal(QObject):
-    """ 设置信号 """
-    currVersion = pyqtSignal(str)  # 当前版本信号
-    newVersion = pyqtSignal(str)   # 最新版本信号
-    completed = pyqtSignal(int)    # 更新完成信号
-    log = pyqtSignal(str)          # 日志信息信号
-    progress = pyqtSignal(int)     # 更新进度信号
+        return getattr(self.signal, name)
 
 
-UPDATE_SIGNAL = UpdateSignal()
+UPDATE_SIGNAL = LazyUpdateSignal()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,316 @@
+""" 差分引擎，包括bsdiff、大文件分窗口差分及完整文件，构建时按文件选择补丁最小的引擎
+:author: 闻煜
+:time: 2026/10/18
+"""
+import hashlib
+import os
+import shutil
+import struct
+import time
+import bsdiff4
+
+
+BSDIFF_ENGINE = 'bsdiff'           # bsdiff补丁，版本描述文件未记录engine时的默认值
+BLOCK_ENGINE = 'block'             # 分窗口差分补丁
+FULL_ENGINE = 'full'               # 完整文件，补丁即新文件，合并时不需要旧文件
+ENGINES = (FULL_ENGINE, BLOCK_ENGINE, BSDIFF_ENGINE)  # 按耗时从小到大排列
+TIME_BUDGET = 10.0                 # 默认单个文件尝试差分引擎的时间预算(秒)
+BLOCK_MAGIC = b'BLKDELTA1'         # 补丁文件头
+BLOCK_SIZE = 64 * 1024             # 定位窗口使用的块大小
+WINDOW_SIZE = 8 * 1024 * 1024      # 默认窗口大小，bsdiff峰值内存约为窗口大小的20倍
+LARGE_FILE_SIZE = 256 * 1024 * 1024  # 默认大文件阈值，超过该大小的文件使用分窗口差分
+
+OP_COPY = 0   # 复制旧文件区间: 偏移, 长度
+OP_PATCH = 1  # 对旧文件区间打补丁: 偏移, 长度, 补丁长度, 补丁
+OP_DATA = 2   # 直接写入数据: 长度, 数据
+
+HEADER = struct.Struct('<QI')       # 新文件大小, 窗口大小
+OP_HEADER = struct.Struct('<B')     # 操作类型
+COPY_ARGS = struct.Struct('<QQ')    # 偏移, 长度
+PATCH_ARGS = struct.Struct('<QQQ')  # 偏移, 长度, 补丁长度
+DATA_ARGS = struct.Struct('<Q')     # 长度
+
+
+def main() -> None:
+    """ 主函数, 程序从该函数运行 """
+
+    # 测试best_diff与file_patch, 补丁结果应与新文件一致
+    engine = best_diff('./update.py', './vbuilder.py', './delta.patch', window_size=4096)
+    file_patch('./update.py', './delta.out', './delta.patch', engine=engine)
+    with open('./delta.out', 'rb') as fp1, open('./vbuilder.py', 'rb') as fp2:
+        print('engine: ', engine, 'patch ok: ', fp1.read() == fp2.read())
+    os.remove('./delta.patch')
+    os.remove('./delta.out')
+
+    return
+
+
+def index_blocks(file: str) -> dict:
+    """ 计算旧文件各对齐块的摘要值，用于为新文件窗口定位旧文件中的对应区间
+
+    :param file: 文件路径
+    :return: {块摘要值: 块偏移}，重复的块只记录第一个
+    """
+    blocks = {}
+    offset = 0
+    with open(file, 'rb') as fp:
+        while True:
+            data = fp.read(BLOCK_SIZE)
+            if not data:
+                break
+            blocks.setdefault(hashlib.md5(data).digest(), offset)
+            offset += len(data)
+
+    return blocks
+
+
+def locate_window(blocks: dict, window: bytes, default: int) -> int:
+    """ 根据新文件窗口中对齐块在旧文件中的位置投票，选出旧文件中对应窗口的起始位置
+
+    :param blocks: 旧文件块索引
+    :param window: 新文件窗口数据
+    :param default: 没有匹配块时的默认起始位置
+    :return: 旧文件窗口起始位置
+    """
+    votes = {}
+    for i in range(0, len(window), BLOCK_SIZE):
+        offset = blocks.get(hashlib.md5(window[i:i + BLOCK_SIZE]).digest())
+        if offset is not None:
+            votes[offset - i] = votes.get(offset - i, 0) + 1
+
+    if not votes:
+        return default
+
+    return max(votes, key=lambda start: (votes[start], -abs(start - default)))
+
+
+def file_diff(old: str, new: str, patch: str, window_size: int = WINDOW_SIZE) -> None:
+    """ 分窗口计算补丁文件。
+    将新文件按window_size切分为窗口，通过块摘要定位每个窗口在旧文件中的对应区间，
+    对区间前后各扩展1/4窗口后与窗口做bsdiff，峰值内存只与窗口大小有关。
+    窗口与旧文件区间相同时只记录复制，补丁比原始数据更大时直接记录数据。
+
+    :param old: 旧文件路径
+    :param new: 新文件路径
+    :param patch: 补丁文件路径
+    :param window_size: 窗口大小
+    """
+    blocks = index_blocks(old)
+    old_size = os.path.getsize(old)
+    margin = window_size // 4
+
+    with open(old, 'rb') as old_fp, open(new, 'rb') as new_fp, open(patch, 'wb') as patch_fp:
+        patch_fp.write(BLOCK_MAGIC)
+        patch_fp.write(HEADER.pack(os.path.getsize(new), window_size))
+        offset = 0
+        while True:
+            window = new_fp.read(window_size)
+            if not window:
+                break
+
+            start = locate_window(blocks, window, offset)
+            old_fp.seek(max(0, start))
+            if 0 <= start <= old_size - len(window) and old_fp.read(len(window)) == window:
+                patch_fp.write(OP_HEADER.pack(OP_COPY) + COPY_ARGS.pack(start, len(window)))
+                offset += len(window)
+                continue
+
+            source_start = min(max(0, start - margin), old_size)
+            source_end = min(max(0, start + len(window) + margin), old_size)
+            old_fp.seek(source_start)
+            data = bsdiff4.diff(old_fp.read(source_end - source_start), window)
+            if len(data) < len(window):
+                patch_fp.write(OP_HEADER.pack(OP_PATCH) + PATCH_ARGS.pack(source_start, source_end - source_start,
+                                                                          len(data)))
+                patch_fp.write(data)
+            else:
+                patch_fp.write(OP_HEADER.pack(OP_DATA) + DATA_ARGS.pack(len(window)))
+                patch_fp.write(window)
+            offset += len(window)
+
+    return
+
+
+def read_exact(fp, size: int, hasher=None) -> bytes:
+    """ 从文件对象读取size字节，数据不足时抛出异常
+
+    :param fp: 文件对象
+    :param size: 读取字节数
+    :param hasher: 摘要对象，不为None时同步计算读取数据的摘要值
+    :return: 读取的数据
+    """
+    data = fp.read(size)
+    while len(data) < size:
+        more = fp.read(size - len(data))
+        if not more:
+            raise ValueError('corrupt block delta patch')
+        data += more
+    if hasher is not None:
+        hasher.update(data)
+
+    return data
+
+
+def patch_stream(old_fp, patch_fp, new_fp, patch_hasher=None, new_hasher=None) -> int:
+    """ 顺序读取补丁并写入新文件，内存占用不超过一个窗口及其补丁
+
+    :param old_fp: 旧文件对象，需要支持seek
+    :param patch_fp: 补丁文件对象，只需顺序读取，可以直接使用更新包中的文件
+    :param new_fp: 新文件对象
+    :param patch_hasher: 摘要对象，不为None时同步计算补丁摘要值
+    :param new_hasher: 摘要对象，不为None时同步计算新文件摘要值
+    :return: 新文件大小
+    """
+    if read_exact(patch_fp, len(BLOCK_MAGIC), patch_hasher) != BLOCK_MAGIC:
+        raise ValueError('not a block delta patch')
+    new_size, _ = HEADER.unpack(read_exact(patch_fp, HEADER.size, patch_hasher))
+
+    written = 0
+    while True:
+        op = patch_fp.read(OP_HEADER.size)
+        if not op:
+            break
+        if patch_hasher is not None:
+            patch_hasher.update(op)
+
+        op, = OP_HEADER.unpack(op)
+        if op == OP_COPY:
+            offset, length = COPY_ARGS.unpack(read_exact(patch_fp, COPY_ARGS.size, patch_hasher))
+            old_fp.seek(offset)
+            data = read_exact(old_fp, length)
+        elif op == OP_PATCH:
+            offset, length, size = PATCH_ARGS.unpack(read_exact(patch_fp, PATCH_ARGS.size, patch_hasher))
+            old_fp.seek(offset)
+            data = bsdiff4.patch(read_exact(old_fp, length), read_exact(patch_fp, size, patch_hasher))
+        elif op == OP_DATA:
+            length, = DATA_ARGS.unpack(read_exact(patch_fp, DATA_ARGS.size, patch_hasher))
+            data = read_exact(patch_fp, length, patch_hasher)
+        else:
+            raise ValueError('unknown block delta op: {}'.format(op))
+
+        if new_hasher is not None:
+            new_hasher.update(data)
+        new_fp.write(data)
+        written += len(data)
+
+    if written != new_size:
+        raise ValueError('block delta size mismatch, expected: {}, actual: {}'.format(new_size, written))
+
+    return written
+
+
+def engine_diff(engine: str, old: str, new: str, patch: str, window_size: int = WINDOW_SIZE) -> None:
+    """ 使用指定差分引擎计算补丁文件
+
+    :param engine: 差分引擎名称
+    :param old: 旧文件路径
+    :param new: 新文件路径
+    :param patch: 补丁文件路径
+    :param window_size: 分窗口差分的窗口大小
+    """
+    if engine == BSDIFF_ENGINE:
+        bsdiff4.file_diff(old, new, patch)
+    elif engine == BLOCK_ENGINE:
+        file_diff(old, new, patch, window_size=window_size)
+    elif engine == FULL_ENGINE:
+        shutil.copyfile(new, patch)
+    else:
+        raise ValueError('unknown delta engine: {}'.format(engine))
+
+    return
+
+
+def best_diff(old: str, new: str, patch: str, engines: tuple = ENGINES, time_budget: float = TIME_BUDGET,
+              window_size: int = WINDOW_SIZE) -> str:
+    """ 依次尝试各差分引擎，保留补丁最小的结果。
+    已用时间超过time_budget后不再尝试剩余引擎，正在执行的引擎不会被中断，
+    因此engines应按耗时从小到大排列，未尝试任何引擎前总会执行第一个引擎。
+
+    :param old: 旧文件路径
+    :param new: 新文件路径
+    :param patch: 补丁文件路径
+    :param engines: 候选差分引擎
+    :param time_budget: 时间预算(秒)
+    :param window_size: 分窗口差分的窗口大小
+    :return: 选中的差分引擎名称
+    """
+    start = time.time()
+    best, best_size = None, None
+    for engine in engines:
+        if best is not None and time.time() - start > time_budget:
+            break
+        candidate = patch + '.' + engine
+        engine_diff(engine, old, new, candidate, window_size=window_size)
+        size = os.path.getsize(candidate)
+        if best is None or size < best_size:
+            if best is not None:
+                os.remove(patch + '.' + best)
+            best, best_size = engine, size
+        else:
+            os.remove(candidate)
+
+    os.replace(patch + '.' + best, patch)
+
+    return best
+
+
+def apply_stream(engine: str, old_fp, patch_fp, new_fp, patch_hasher=None, new_hasher=None) -> int:
+    """ 使用指定差分引擎的补丁生成新文件，合并时同步计算补丁与新文件的摘要值
+
+    :param engine: 差分引擎名称
+    :param old_fp: 旧文件对象，完整文件引擎不需要，可以为None
+    :param patch_fp: 补丁文件对象
+    :param new_fp: 新文件对象
+    :param patch_hasher: 摘要对象，不为None时同步计算补丁摘要值
+    :param new_hasher: 摘要对象，不为None时同步计算新文件摘要值
+    :return: 新文件大小
+    """
+    if engine == BLOCK_ENGINE:
+        return patch_stream(old_fp, patch_fp, new_fp, patch_hasher, new_hasher)
+
+    if engine == FULL_ENGINE:
+        size = 0
+        while True:
+            data = patch_fp.read(WINDOW_SIZE)
+            if not data:
+                break
+            for hasher in (patch_hasher, new_hasher):
+                if hasher is not None:
+                    hasher.update(data)
+            new_fp.write(data)
+            size += len(data)
+        return size
+
+    if engine == BSDIFF_ENGINE:
+        patch = patch_fp.read()
+        if patch_hasher is not None:
+            patch_hasher.update(patch)
+        data = bsdiff4.patch(old_fp.read(), patch)
+        if new_hasher is not None:
+            new_hasher.update(data)
+        new_fp.write(data)
+        return len(data)
+
+    raise ValueError('unknown delta engine: {}'.format(engine))
+
+
+def file_patch(old: str, new: str, patch: str, engine: str = BLOCK_ENGINE) -> None:
+    """ 使用补丁文件由旧文件生成新文件，旧文件与新文件不能为同一文件
+
+    :param old: 旧文件路径
+    :param new: 新文件路径
+    :param patch: 补丁文件路径
+    :param engine: 差分引擎名称
+    """
+    with open(patch, 'rb') as patch_fp, open(new, 'wb') as new_fp:
+        if engine == FULL_ENGINE:
+            apply_stream(engine, None, patch_fp, new_fp)
+        else:
+            with open(old, 'rb') as old_fp:
+                apply_stream(engine, old_fp, patch_fp, new_fp)
+
+    return
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+""" 更新事件，更新程序通过回调函数通知版本、进度、日志等事件，不依赖Qt；
+界面通过bridge_signal将事件转发为Qt信号，命令行通过订阅事件输出JSON。
+:author: 闻煜
+:time: 2026/10/18
+"""
+import threading
+
+
+CURR_VERSION = 'currVersion'  # 当前版本, 参数: 版本号
+NEW_VERSION = 'newVersion'    # 最新版本, 参数: 版本号
+PROGRESS = 'progress'         # 下载或合并进度, 参数: 0~100
+STEP = 'step'                 # 更新路径中的一个版本更新完成, 参数: 版本号
+COMPLETED = 'completed'       # 更新完成, 参数: 是否成功
+LOG = 'log'                   # 日志信息, 参数: 日志，短时间内的多条日志以换行合并
+EVENTS = (CURR_VERSION, NEW_VERSION, PROGRESS, STEP, COMPLETED, LOG)
+
+
+def main() -> None:
+    """ 主函数, 程序从该函数运行 """
+
+    # 测试UpdateEvents, 订阅进度事件并发送
+    events = UpdateEvents()
+    events.subscribe(PROGRESS, lambda percent: print('progress: ', percent))
+    for percent in (0, 50, 100):
+        events.emit(PROGRESS, percent)
+
+    return
+
+
+class UpdateEvents:
+    """ 更新事件类，订阅者为回调函数，在发送事件的线程中调用 """
+
+    def __init__(self) -> None:
+        """ 构造函数，初始化订阅列表 """
+
+        self.handlers = {event: [] for event in EVENTS}
+        self.lock = threading.Lock()
+
+        return
+
+    def subscribe(self, event: str, handler) -> None:
+        """ 订阅事件
+
+        :param event: 事件名称, eg: PROGRESS
+        :param handler: 回调函数，参数与事件相同
+        """
+
+        with self.lock:
+            self.handlers[event] = self.handlers[event] + [handler]
+
+        return
+
+    def unsubscribe(self, event: str, handler) -> None:
+        """ 取消订阅事件
+
+        :param event: 事件名称
+        :param handler: 订阅时的回调函数
+        """
+
+        with self.lock:
+            self.handlers[event] = [item for item in self.handlers[event] if item is not handler]
+
+        return
+
+    def emit(self, event: str, *args) -> None:
+        """ 发送事件，回调函数异常不影响更新
+
+        :param event: 事件名称
+        :param args: 事件参数
+        """
+
+        for handler in self.handlers[event]:
+            try:
+                handler(*args)
+            except Exception as e:
+                print('handle event {} error, reason: {}!'.format(event, e))
+
+        return
+
+
+def bridge_signal(events: UpdateEvents, signal) -> None:
+    """ 将更新事件转发为Qt信号，界面在主线程中调用，工作线程发送的事件由Qt排队至界面线程处理
+
+    :param events: 更新事件对象
+    :param signal: 更新信号对象, eg: UPDATE_SIGNAL
+    """
+
+    events.subscribe(CURR_VERSION, signal.currVersion.emit)
+    events.subscribe(NEW_VERSION, signal.newVersion.emit)
+    events.subscribe(PROGRESS, signal.progress.emit)
+    events.subscribe(COMPLETED, signal.completed.emit)
+    events.subscribe(LOG, signal.log.emit)
+
+    return
+
+
+# 更新程序默认使用的事件对象
+UPDATE_EVENTS = UpdateEvents()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,203 @@
+""" 局域网更新包缓存，客户端之间共享已下载的更新包，减少文件服务器出口带宽
+通过UDP广播按摘要值查询局域网内持有更新包的节点，再通过HTTP下载，下载后必须校验摘要值。
+:author: 闻煜
+:time: 2026/10/18
+"""
+import argparse
+import functools
+import json
+import os
+import socket
+import threading
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+import util
+
+
+LAN_PORT = 18026          # 默认端口，UDP查询与HTTP下载使用相同端口号
+LAN_BROADCAST = '255.255.255.255'
+QUERY_TIMEOUT = 1.0       # 默认查询等待时间(秒)
+STORE_SIZE = 3            # 默认本地保留的更新包数量
+
+
+def main() -> None:
+    """ 主函数, 程序从该函数运行。
+    启动缓存节点: python lancache.py serve ./lan_cache --port 18026
+    查询更新包:   python lancache.py query sha256 <digest> --address 127.0.0.1 --port 18026
+    """
+
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command')
+    serve_parser = subparsers.add_parser('serve', help=u'启动局域网缓存节点')
+    serve_parser.add_argument('StorePath', type=str, help=u'更新包存储目录')
+    serve_parser.add_argument('--port', type=int, default=LAN_PORT)
+    query_parser = subparsers.add_parser('query', help=u'查询持有更新包的节点')
+    query_parser.add_argument('Algorithm', type=str, help=u'摘要算法')
+    query_parser.add_argument('Digest', type=str, help=u'更新包摘要值')
+    query_parser.add_argument('--address', type=str, default=LAN_BROADCAST)
+    query_parser.add_argument('--port', type=int, default=LAN_PORT)
+    query_parser.add_argument('--timeout', type=float, default=QUERY_TIMEOUT)
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        print('lan cache serve: ', args.StorePath, args.port)
+        LanCacheServer(args.StorePath, port=args.port).serve_forever()
+    elif args.command == 'query':
+        print(discover(args.Algorithm, args.Digest, address=args.address, port=args.port, timeout=args.timeout))
+    else:
+        parser.print_help()
+
+    return
+
+
+def store_name(algorithm: str, digest: str) -> str:
+    """ 更新包在存储目录中的文件名称, eg: sha256-9f86d081...
+
+    :param algorithm: 摘要算法
+    :param digest: 摘要值
+    :return: 文件名称
+    """
+    return '{}-{}'.format(algorithm, digest.lower())
+
+
+def discover(algorithm: str, digest: str, address: str = LAN_BROADCAST, port: int = LAN_PORT,
+             timeout: float = QUERY_TIMEOUT) -> list:
+    """ 广播查询持有指定更新包的节点，在timeout内收集所有应答
+
+    :param algorithm: 摘要算法
+    :param digest: 更新包摘要值
+    :param address: 广播地址，也可以是单个节点地址
+    :param port: 节点端口
+    :param timeout: 等待应答时间(秒)
+    :return: 更新包下载地址列表，按应答先后排序
+    """
+    name = store_name(algorithm, digest)
+    urls = []
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        sock.settimeout(timeout)
+        sock.sendto(json.dumps({'query': name}).encode('utf-8'), (address, port))
+        while True:
+            try:
+                data, peer = sock.recvfrom(1024)
+            except socket.timeout:
+                break
+            try:
+                answer = json.loads(data.decode('utf-8'))
+            except ValueError:
+                continue
+            url = 'http://{}:{}/{}'.format(peer[0], answer.get('port', port), name)
+            if answer.get('name') == name and url not in urls:
+                urls.append(url)
+
+    return urls
+
+
+def store_package(store_path: str, package_file: str, algorithm: str, digest: str, keep: int = STORE_SIZE) -> None:
+    """ 将已校验的更新包保存至存储目录供局域网内其它节点下载，只保留最近keep个
+
+    :param store_path: 存储目录
+    :param package_file: 更新包路径
+    :param algorithm: 摘要算法
+    :param digest: 摘要值
+    :param keep: 保留的更新包数量
+    """
+    os.makedirs(store_path, exist_ok=True)
+    target = os.path.join(store_path, store_name(algorithm, digest))
+    if not os.path.exists(target):
+        util.link_file(package_file, target + '.tmp')
+        os.replace(target + '.tmp', target)
+    os.utime(target)
+
+    names = [name for name in os.listdir(store_path) if not name.endswith('.tmp')]
+    names.sort(key=lambda item: os.path.getmtime(os.path.join(store_path, item)), reverse=True)
+    for name in names[keep:]:
+        os.remove(os.path.join(store_path, name))
+
+    return
+
+
+class StoreRequestHandler(SimpleHTTPRequestHandler):
+    """ 存储目录HTTP请求处理类，只提供文件下载，不提供目录列表 """
+
+    def list_directory(self, path):
+        """ 禁止列出目录 """
+        self.send_error(404)
+        return None
+
+    def log_message(self, format, *args) -> None:
+        """ 不输出访问日志 """
+        return
+
+
+class LanCacheServer:
+    """ 局域网缓存节点类，UDP应答查询，HTTP提供存储目录中的更新包下载 """
+
+    def __init__(self, store_path: str, port: int = LAN_PORT, host: str = '') -> None:
+        """ 构造函数，绑定UDP与HTTP端口
+
+        :param store_path: 更新包存储目录
+        :param port: 端口，UDP与HTTP使用相同端口号
+        :param host: 监听地址，默认为全部地址
+        """
+
+        self.storePath = store_path
+        os.makedirs(store_path, exist_ok=True)
+
+        handler = functools.partial(StoreRequestHandler, directory=os.path.abspath(store_path))
+        self.httpServer = ThreadingHTTPServer((host, port), handler)
+        self.port = self.httpServer.server_address[1]  # port为0时使用系统分配的端口
+        self.udpSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udpSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.udpSocket.bind((host, self.port))
+        self.threads = []
+
+        return
+
+    def start(self) -> None:
+        """ 在后台线程中启动UDP应答与HTTP服务 """
+
+        self.threads = [threading.Thread(target=self.__answer, daemon=True),
+                        threading.Thread(target=self.httpServer.serve_forever, daemon=True)]
+        for thread in self.threads:
+            thread.start()
+
+        return
+
+    def serve_forever(self) -> None:
+        """ 启动服务并阻塞当前线程 """
+
+        self.start()
+        for thread in self.threads:
+            thread.join()
+
+        return
+
+    def shutdown(self) -> None:
+        """ 停止服务 """
+
+        self.httpServer.shutdown()
+        self.httpServer.server_close()
+        self.udpSocket.close()
+
+        return
+
+    def __answer(self) -> None:
+        """ 应答查询，存储目录中存在该更新包时回复HTTP端口 """
+
+        while True:
+            try:
+                data, peer = self.udpSocket.recvfrom(1024)
+            except OSError:  # socket已关闭
+                break
+            try:
+                name = json.loads(data.decode('utf-8'))['query']
+            except (ValueError, KeyError, TypeError):
+                continue
+            if os.path.basename(name) == name and os.path.isfile(os.path.join(self.storePath, name)):
+                self.udpSocket.sendto(json.dumps({'name': name, 'port': self.port}).encode('utf-8'), peer)
+
+        return
+
+
+if __name__ == '__main__':
+    main()
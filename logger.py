@@ -0,0 +1,245 @@
+""" 日志处理，日志先写入队列，由后台线程批量写入日志文件并按大小轮转，更新线程不等待日志IO
+:author: 闻煜
+:time: 2026/10/18
+"""
+import atexit
+import os
+import queue
+import threading
+import time
+from config import UpdaterConfigInfo
+import events
+
+
+LOG_MAX_SIZE = 1024 * 1024  # 默认单个日志文件最大字节数，超过时轮转
+LOG_BACKUPS = 3             # 默认保留的历史日志文件数量, eg: update.log.1 ~ update.log.3
+FLUSH_INTERVAL = 0.5        # 批量写入间隔(秒)
+SIGNAL_INTERVAL = 0.1       # 界面日志最短发送间隔(秒)，间隔内的日志合并发送
+FLUSH = object()            # 队列中的刷新标记
+
+LOGGER = None               # 更新程序日志对象，首次记录日志时根据配置文件创建
+LOGGER_LOCK = threading.Lock()
+
+
+def main() -> None:
+    """ 主函数, 程序从该函数运行 """
+
+    # 测试Logger, 写入10000条日志，每50KB轮转一次，界面日志合并发送
+    emitted = []
+    logger = Logger('./log/test.log', max_size=50 * 1024, backups=2, signal=emitted.append, echo=False)
+    start = time.time()
+    for i in range(10000):
+        logger.log('测试日志: {}'.format(i))
+    print('log elapsed: ', time.time() - start)
+    logger.close()
+    print('closed elapsed: ', time.time() - start)
+    print('signal emitted: ', len(emitted), sorted(os.listdir('./log')))
+
+    return
+
+
+def init_log(config: UpdaterConfigInfo) -> 'Logger':
+    """ 根据配置信息创建更新程序日志对象，只创建一次
+
+    :param config: 更新程序配置信息
+    :return: 日志对象
+    """
+
+    global LOGGER
+    with LOGGER_LOCK:
+        if LOGGER is None:
+            LOGGER = Logger(config.logPath, max_size=config.logMaxSize, backups=config.logBackups, signal=emit_log)
+
+    return LOGGER
+
+
+def log(info: str, level: str = 'info') -> None:
+    """ 日志处理，日志由后台线程写入文件并发送至界面，不阻塞更新 """
+
+    (LOGGER or init_log(UpdaterConfigInfo())).log(info, level)
+
+
+def flush_log() -> None:
+    """ 等待已记录的日志全部写入并发送至界面 """
+
+    if LOGGER is not None:
+        LOGGER.flush()
+
+
+def emit_log(info: str) -> None:
+    """ 发送日志事件，界面及命令行通过订阅events.LOG接收日志 """
+
+    events.UPDATE_EVENTS.emit(events.LOG, info)
+
+
+class Logger:
+    """ 日志类，log只将日志放入队列，后台线程批量写入日志文件、打印至控制台并合并发送至界面 """
+
+    def __init__(self, log_path: str, max_size: int = LOG_MAX_SIZE, backups: int = LOG_BACKUPS, signal=None,
+                 signal_interval: float = SIGNAL_INTERVAL, echo: bool = True) -> None:
+        """ 构造函数，启动后台写入线程
+
+        :param log_path: 日志文件路径
+        :param max_size: 单个日志文件最大字节数，为0时不轮转
+        :param backups: 保留的历史日志文件数量
+        :param signal: 日志事件回调函数, eg: emit_log，为None时不发送
+        :param signal_interval: 界面日志最短发送间隔(秒)
+        :param echo: 是否打印至控制台
+        """
+
+        self.logPath = log_path
+        self.maxSize = max_size
+        self.backups = backups
+        self.signal = signal
+        self.signalInterval = signal_interval
+        self.echo = echo
+        self.queue = queue.Queue()
+        self.fp = None
+        self.pending = []         # 等待发送至界面的日志
+        self.signalTime = 0       # 上次发送界面日志的时间
+        self.closed = False
+
+        self.thread = threading.Thread(target=self.__write, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)  # sys.exit退出时写完队列中的日志
+
+        return
+
+    def log(self, info, level: str = 'info') -> None:
+        """ 记录日志，只放入队列，立即返回
+
+        :param info: 日志信息
+        :param level: 日志级别
+        """
+
+        self.queue.put((time.time(), level, str(info)))
+
+        return
+
+    def flush(self) -> None:
+        """ 等待队列中的日志全部写入并发送至界面 """
+
+        if not self.closed:
+            self.queue.put(FLUSH)
+            self.queue.join()
+
+        return
+
+    def close(self) -> None:
+        """ 写完队列中的日志后停止后台线程并关闭日志文件 """
+
+        if self.closed:
+            return
+
+        self.closed = True
+        self.queue.put(None)
+        self.thread.join()
+
+        return
+
+    def __write(self) -> None:
+        """ 后台写入线程，每次取出队列中的全部日志批量写入 """
+
+        stopped = False
+        while not stopped:
+            # 有等待发送的界面日志时，最多等待到下次可以发送的时间
+            timeout = FLUSH_INTERVAL
+            if self.pending:
+                timeout = max(0.0, min(timeout, self.signalTime + self.signalInterval - time.monotonic()))
+            try:
+                records = [self.queue.get(timeout=timeout)]
+            except queue.Empty:
+                records = []
+            while True:
+                try:
+                    records.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            stopped = None in records
+            force = stopped or FLUSH in records
+            logs = [record for record in records if record is not None and record is not FLUSH]
+
+            if logs:
+                self.__write_file(['[{}][{}] {}'.format(
+                    time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp)), level, info)
+                    for timestamp, level, info in logs])
+            self.__emit([info for _, _, info in logs], force=force)
+
+            for _ in records:
+                self.queue.task_done()
+
+        if self.fp is not None:
+            self.fp.close()
+            self.fp = None
+
+        return
+
+    def __write_file(self, lines: list) -> None:
+        """ 写入日志文件，超过大小时轮转
+
+        :param lines: 已格式化的日志
+        """
+
+        if self.echo:
+            print('\n'.join(lines))
+
+        try:
+            if self.fp is None:
+                log_dir = os.path.dirname(self.logPath)
+                if log_dir and not os.path.exists(log_dir):
+                    os.makedirs(log_dir, exist_ok=True)
+                self.fp = open(self.logPath, 'ab')
+            for line in lines:
+                data = (line + '\n').encode('utf-8')
+                if 0 < self.maxSize < self.fp.tell() + len(data) and self.fp.tell() > 0:
+                    self.__rotate()
+                self.fp.write(data)
+            self.fp.flush()
+        except OSError as e:
+            # 日志写入失败不影响更新
+            print('write log {} error, reason: {}!'.format(self.logPath, e))
+            if self.fp is not None:
+                self.fp.close()
+                self.fp = None
+
+        return
+
+    def __rotate(self) -> None:
+        """ 日志轮转, update.log -> update.log.1 -> update.log.2 ... 超出数量的删除 """
+
+        self.fp.close()
+        self.fp = None
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists('{}.{}'.format(self.logPath, i)):
+                os.replace('{}.{}'.format(self.logPath, i), '{}.{}'.format(self.logPath, i + 1))
+        if self.backups > 0:
+            os.replace(self.logPath, self.logPath + '.1')
+        else:
+            os.remove(self.logPath)
+        self.fp = open(self.logPath, 'ab')
+
+        return
+
+    def __emit(self, infos: list, force: bool = False) -> None:
+        """ 发送界面日志，signal_interval内的日志合并为一条发送，避免大量日志阻塞界面
+
+        :param infos: 日志信息
+        :param force: 为True时立即发送
+        """
+
+        if self.signal is None:
+            return
+
+        self.pending.extend(infos)
+        now = time.monotonic()
+        if self.pending and (force or now - self.signalTime >= self.signalInterval):
+            self.signal('\n'.join(self.pending))
+            self.pending = []
+            self.signalTime = now
+
+        return
+
+
+if __name__ == '__main__':
+    main()
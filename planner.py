@@ -0,0 +1,126 @@
+""" 更新路径规划，根据发布目录索引选择下载量最小的更新路径
+:author: 闻煜
+:time: 2026/10/18
+"""
+import heapq
+import util
+
+
+def main() -> None:
+    """ 主函数, 程序从该函数运行 """
+
+    # 测试plan_update, 1.0 -> 1.1 -> 1.2 增量更新链与 2.0 全量更新包
+    index = util.read_json('index.json')
+    steps = plan_update(index, '1.0')
+    print('plan: ', [(step['version'], step['package']['file']) for step in steps])
+    print('size: ', plan_size(steps))
+
+    return
+
+
+def plan_update(index: dict, current_version: str, target_version: str = None) -> list:
+    """ 规划从当前版本到目标版本下载量最小的更新路径。
+    将索引文件中的每个更新包视为一条边，边的权重为更新包大小：
+    增量更新包为baseVersion -> version的边，未指定baseVersion时基于上一版本；
+    全量更新包可以从任意更低版本直接更新，为所有更低版本 -> version的边。
+    使用Dijkstra算法求最短路径，下载量相同时选择更新步骤更少的路径。
+
+    :param index: 发布目录索引信息
+    :param current_version: 当前版本号
+    :param target_version: 目标版本号，默认为最新版本
+    :return: 更新步骤列表，每一步为{'version': 版本号, 'package': 更新包信息}；
+             无需更新时返回空列表，目标版本不可达时返回None
+    """
+
+    # 参与规划的版本节点：当前版本及所有更新的版本，按版本号从小到大排序
+    versions = [item for item in index['versions'] if util.compare_version(item['version'], current_version) == 1]
+    versions.sort(key=util.cmp_to_key(lambda a, b: util.compare_version(a['version'], b['version'])))
+    if len(versions) == 0:
+        return []
+    nodes = [current_version] + [item['version'] for item in versions]
+    if target_version is None:
+        target_version = nodes[-1]
+
+    # 构造边, edges[from] = [(to, package)]
+    edges = {node: [] for node in nodes}
+    for i in range(1, len(nodes)):
+        for package in versions[i - 1].get('packages', []):
+            if not package.get('incUpdateFlag', True):  # 全量更新包
+                for node in nodes[:i]:
+                    edges[node].append((nodes[i], package))
+                continue
+
+            base_version = package.get('baseVersion') or nodes[i - 1]
+            for node in nodes[:i]:
+                if util.compare_version(node, base_version) == 0:
+                    edges[node].append((nodes[i], package))
+                    break
+
+    # Dijkstra最短路径, 权重为(下载字节数, 更新步骤数)
+    distances = {current_version: (0, 0)}
+    previous = {}
+    queue = [(0, 0, 0, current_version)]
+    while queue:
+        size, steps, _, node = heapq.heappop(queue)
+        if (size, steps) > distances[node]:
+            continue
+        if node == target_version:
+            break
+        for next_node, package in edges[node]:
+            weight = (size + package.get('size', 0), steps + 1)
+            if next_node not in distances or weight < distances[next_node]:
+                distances[next_node] = weight
+                previous[next_node] = (node, package)
+                heapq.heappush(queue, (weight[0], weight[1], nodes.index(next_node), next_node))
+
+    if target_version not in previous:
+        return None
+
+    # 回溯更新路径
+    plan = []
+    node = target_version
+    while node != current_version:
+        node_from, package = previous[node]
+        plan.append({'version': node, 'package': package})
+        node = node_from
+    plan.reverse()
+
+    return plan
+
+
+def rollout_versions(index: dict, current_version: str) -> tuple:
+    """ 按索引文件中各版本的灰度发布比例(rollout)过滤版本。
+    根据本机标识与版本号计算固定的分桶(0~99)，分桶小于rollout时才更新该版本；
+    第一个不更新的版本之后的版本也不更新，保证增量更新路径连续。
+
+    :param index: 发布目录索引信息
+    :param current_version: 当前版本号
+    :return: (允许更新的版本信息列表, 第一个暂不更新的版本信息，全部允许时为None)
+    """
+
+    versions = sorted(index['versions'],
+                      key=util.cmp_to_key(lambda a, b: util.compare_version(a['version'], b['version'])))
+    allowed = []
+    machine_id = None
+    for item in versions:
+        rollout = item.get('rollout', 100)
+        if rollout < 100 and util.compare_version(item['version'], current_version) == 1:
+            machine_id = machine_id or util.get_machine_id()
+            if util.rollout_bucket(machine_id, item['version']) >= rollout:
+                return allowed, item
+        allowed.append(item)
+
+    return allowed, None
+
+
+def plan_size(plan: list) -> int:
+    """ 统计更新路径总下载量
+
+    :param plan: 更新步骤列表
+    :return: 总下载字节数
+    """
+    return sum(step['package'].get('size', 0) for step in plan if step['package'] is not None)
+
+
+if __name__ == '__main__':
+    main()
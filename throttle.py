@@ -0,0 +1,111 @@
+""" 下载限速，基于令牌桶算法，支持按时间段限速
+:author: 闻煜
+:time: 2026/10/18
+"""
+import threading
+import time
+
+
+def main() -> None:
+    """ 主函数, 程序从该函数运行 """
+
+    # 测试RateLimiter, 100KB/s限速下消耗300KB约需要2秒(桶内初始有1秒的令牌)
+    limiter = RateLimiter(100 * 1024)
+    start = time.time()
+    for _ in range(300):
+        limiter.consume(1024)
+    print('elapsed: ', time.time() - start)
+
+    # 测试parse_hours与in_hours
+    hours = parse_hours('08:00-18:00,22:00-06:00')
+    print(hours, in_hours(hours, 9 * 60), in_hours(hours, 20 * 60), in_hours(hours, 23 * 60))
+
+    return
+
+
+def parse_hours(hours: str) -> list:
+    """ 解析限速时间段, eg: 08:00-18:00,22:00-06:00
+
+    :param hours: 以,分隔的时间段，结束时间小于开始时间表示跨越零点
+    :return: [(开始分钟, 结束分钟)]
+    """
+    ranges = []
+    for item in hours.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        start, end = item.split('-')
+        ranges.append(tuple(int(t.split(':')[0]) * 60 + int(t.split(':')[1]) for t in (start, end)))
+
+    return ranges
+
+
+def in_hours(ranges: list, minute: int = None) -> bool:
+    """ 判断时间是否在时间段内
+
+    :param ranges: parse_hours解析的时间段
+    :param minute: 当天的第几分钟，默认为当前时间
+    :return: 在任一时间段内时返回True
+    """
+    if minute is None:
+        now = time.localtime()
+        minute = now.tm_hour * 60 + now.tm_min
+
+    for start, end in ranges:
+        if start <= end and start <= minute < end:
+            return True
+        if start > end and (minute >= start or minute < end):
+            return True
+
+    return False
+
+
+class RateLimiter:
+    """ 令牌桶限速类，令牌以rate字节/秒的速度生成，桶容量为1秒的令牌。
+    多个下载线程共用同一个限速对象时，总下载速度不超过rate。
+    """
+
+    def __init__(self, rate: float = 0, hours: str = '') -> None:
+        """ 构造函数，初始化令牌桶
+
+        :param rate: 限速(字节/秒)，0表示不限速
+        :param hours: 限速时间段，为空时全天限速, eg: 08:00-18:00
+        """
+
+        self.rate = rate
+        self.hours = parse_hours(hours)
+        self.tokens = rate                  # 当前令牌数，可以为负数，表示需要等待的字节数
+        self.timestamp = time.monotonic()   # 上次补充令牌的时间
+        self.lock = threading.Lock()
+
+        return
+
+    def limited(self) -> bool:
+        """ 当前时间是否需要限速 """
+        return self.rate > 0 and (not self.hours or in_hours(self.hours))
+
+    def consume(self, size: int) -> None:
+        """ 消耗size字节的令牌，令牌不足时等待
+
+        :param size: 已下载的字节数
+        """
+
+        if not self.limited():
+            return
+
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.timestamp) * self.rate)
+            self.timestamp = now
+            self.tokens -= size
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+
+        # 在锁外等待，其它线程消耗令牌时会累计等待时间
+        if wait > 0:
+            time.sleep(wait)
+
+        return
+
+
+if __name__ == '__main__':
+    main()
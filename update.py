@@ -2,18 +2,45 @@
 :author: 闻煜
 :time: 2022/09/27
 """
+import json
 import os.path
+import posixpath
 import re
 import shutil
 import sys
+import threading
 import time
-import urllib.request
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
 import bsdiff4
+import psutil
 import urllib3.exceptions
 from html.parser import HTMLParser
 import urllib3
-from config import UpdaterConfigInfo, UPDATE_SIGNAL
+from config import UpdaterConfigInfo
+import check
+from check import INDEX_FILE
+import chunkstore
+import delta
+import events
+import lancache
+from logger import init_log, log
+import planner
+import throttle
 import util
+from util import compare_version
+
+# 下载更新包时每次读取的数据块大小
+FETCH_BLOCK_SIZE = 64 * 1024
+
+
+def zip_member(path: str) -> str:
+    """ 将版本文件中的路径转换为zip更新包中的文件名称, eg: .\\sub\\app.dll -> sub/app.dll
+
+    :param path: 版本文件中的路径
+    :return: zip文件名称
+    """
+    return posixpath.normpath(path.replace('\\', '/')).lstrip('/')
 
 
 def main():
@@ -40,65 +67,78 @@ def main():
     return
 
 
-def log(info: str) -> None:
-    """ 日志处理 """
+class UpdateCancelled(Exception):
+    """ 更新被取消，下载与合并在数据块或文件之间停止，已下载的部分保留用于续传 """
 
-    UPDATE_SIGNAL.log.emit(info)
-    print('[{}][info] '.format(time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time()))), info)
-
-    update_config = UpdaterConfigInfo()
-    log_path = os.path.dirname(update_config.logPath)
-    if not os.path.exists(log_path):
-        print('日志路径不存在，正在创建目录.')
-        os.makedirs(log_path)
-
-    with open(update_config.logPath, 'a') as f:
-        f.write('[{}][info] {}\n'.format(time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time())), info))
 
+class Update:
+    """ 更新程序类，主要负责更新 """
 
-def compare_version(version1: str, version2: str) -> int:
-    """ 比较版本号version1和version2。
-    版本号由一个或多个修订号组成，各修订号由一个 '.' 连接。
-    每个修订号由多位数字组成，可能包含前导零 。每个版本号至少包含一个字符。
-    修订号从左到右编号，下标从 0 开始，最左边的修订号下标为 0 ，下一个修订号下标为 1 ，以此类推。
-    例如，2.5.33 和 0.1 都是有效的版本号。
-    比较版本号时，请按从左到右的顺序依次比较它们的修订号。
-    比较修订号时，只需比较 忽略任何前导零后的整数值 。
-    也就是说，修订号 1 和修订号 001 相等 。
-    如果版本号没有指定某个下标处的修订号，则该修订号视为 0 。
-    例如，版本 1.0 小于版本 1.1 ，因为它们下标为 0 的修订号相同，而下标为 1 的修订号分别为 0 和 1 ，0 < 1 。
+    def __init__(self, config_path: str = 'update.ini', update_events: events.UpdateEvents = None) -> None:
+        """ 构造函数，初始化变量信息
 
-    :param version1: 版本号1
-    :param version2: 版本号2
-    :return: 如果version1>version2, 返回1, 如果version1<version2, 返回-1, 除此之外返回0
-    """
-    arr1 = version1.split('.')
-    arr2 = version2.split('.')
-    max_length = max(len(arr1), len(arr2))
-    for i in range(0, max_length):
-        num1 = int(arr1[i]) if i < len(arr1) else 0
-        num2 = int(arr2[i]) if i < len(arr2) else 0
-        if num1 == num2:
-            continue
-        return 1 if num1 > num2 else -1
+        :param config_path: 配置文件路径
+        :param update_events: 进度等更新事件的发送对象，默认为events.UPDATE_EVENTS；日志事件始终由UPDATE_EVENTS发送
+        """
 
-    return 0
+        self.config = UpdaterConfigInfo(config_path)
+        self.events = update_events or events.UPDATE_EVENTS
+        init_log(self.config)
+        self.updateVersionList = []
+        self.releaseIndex = None  # 发布目录索引文件index.json内容，服务器未提供时为None
+        self.stagingPath = None   # 分阶段安装暂存目录，未启用分阶段安装时为None
 
+        # 所有文件服务器访问共用同一个连接池，HTTP/1.1长连接在多次请求间复用
+        retries = urllib3.Retry(total=self.config.retries, backoff_factor=self.config.backoffFactor,
+                                status_forcelist=(429, 500, 502, 503, 504), raise_on_status=False)
+        self.http = urllib3.PoolManager(
+            maxsize=2,  # 版本列表/更新包下载线程与合并线程
+            timeout=urllib3.Timeout(connect=self.config.connectTimeout, read=self.config.readTimeout),
+            retries=retries)
 
-class Update:
-    """ 更新程序类，主要负责更新 """
+        # 版本列表请求只重试网络错误，429/5xx直接记录退避状态，避免应用程序启动时长时间阻塞
+        self.listingRetries = retries.new(status_forcelist=(), respect_retry_after_header=False)
 
-    def __init__(self, config_path: str = 'update.ini') -> None:
-        """ 构造函数，初始化变量信息 """
+        # 所有下载共用同一个限速对象，总下载速度不超过配置的限速
+        self.limiter = throttle.RateLimiter(self.config.rateLimit, self.config.rateLimitHours)
 
-        self.config = UpdaterConfigInfo(config_path)
-        self.updateVersionList = []
+        # 取消标记，由其它线程设置，下载与合并在下一个数据块或文件处检查
+        self.cancelEvent = threading.Event()
+        self.previousVersion = None  # 本次更新前的版本号
 
         return
 
     def run(self) -> None:
         """ 执行更新过程 """
 
+        # 1）~ 4）获取更新列表、规划更新路径并建立暂存目录
+        update_plan = self.prepareUpdate()
+        if len(update_plan) == 0:
+            return
+
+        try:
+            if update_plan[0].get('chunkManifest'):  # 分块更新直接更新至最新版本
+                self.patchStep(update_plan[0])
+            else:
+                self.__apply_plan(update_plan)
+        except BaseException:
+            self.abortUpdate()
+            raise
+
+        # 5）切换至暂存目录并写回版本号
+        self.finishUpdate(update_plan)
+
+        return
+
+    def prepareUpdate(self) -> list:
+        """ 更新前的准备：获取更新列表、规划更新路径，分阶段安装时建立暂存目录
+
+        :return: 更新步骤列表，无需更新时返回空列表
+        """
+
+        # 前台更新优先，结束正在运行的后台预下载，已下载的部分在本次更新中续传
+        self.__stop_prefetch()
+
         # TODO LOG 日志处理优化
         log('正在加载文件服务器:{}.'.format(self.config.serverUrl))
 
@@ -110,24 +150,319 @@ class Update:
         # 2）判断是否需要更新
         if len(update_version_list) == 0:
             print('无新版本！')
+            return []
+
+        # 3）规划更新路径
+        update_plan = self.planUpdate()
+        self.previousVersion = self.config.version
+
+        # 4）分阶段安装时，先以硬链接建立暂存目录，全部更新在暂存目录中完成，失败时程序目录保持不变
+        if self.config.stagedInstall:
+            self.stagingPath = self.__stage()
+
+        return update_plan
+
+    def fetchStep(self, step: dict) -> None:
+        """ 拉取更新路径中一步的更新包，分块更新在合并时下载分块
+
+        :param step: 更新步骤, {'version': 版本号, 'package': 更新包信息}
+        """
+
+        if not step.get('chunkManifest'):
+            self.__fetch(step['version'], step['package'])
+
+        return
+
+    def patchStep(self, step: dict) -> None:
+        """ 合并更新路径中的一步，需要先调用fetchStep拉取更新包
+
+        :param step: 更新步骤, {'version': 版本号, 'package': 更新包信息}
+        """
+
+        self.checkCancelled()
+        if step.get('chunkManifest'):
+            log('正在分块更新至{}版本.'.format(step['version']))
+            self.__chunk_patch(step['version'], step['chunkManifest'])
+        else:
+            # 解压并合并更新包
+            log('正在合并{}更新包.'.format(step['version']))
+            self.__patch(step['version'], step['package'])
+        log('版本{}更新成功.'.format(step['version']))
+        self.events.emit(events.STEP, step['version'])
+
+        return
+
+    def finishUpdate(self, update_plan: list) -> None:
+        """ 全部步骤合并完成后，切换至暂存目录，原版本保留为硬链接快照，用于回滚；版本号与退出码一次写回配置文件
+
+        :param update_plan: 更新步骤列表
+        """
+
+        with self.config.batch():
+            if self.stagingPath is not None:
+                self.__swap(self.previousVersion)
+                self.config.writeConfigFile('program', 'version', update_plan[-1]['version'])
+
+            # 更新成功
+            self.config.writeConfigFile('update', 'exitCode', '0')
+
+        return
+
+    def abortUpdate(self) -> None:
+        """ 更新失败或取消时删除暂存目录，程序目录保持不变 """
+
+        if self.stagingPath is not None:
+            shutil.rmtree(self.stagingPath, ignore_errors=True)
+            self.stagingPath = None
+
+        return
+
+    def cancel(self) -> None:
+        """ 请求取消更新，可以在其它线程中调用，下载与合并在下一个数据块或文件处抛出UpdateCancelled """
+
+        self.cancelEvent.set()
+
+        return
+
+    def checkCancelled(self) -> None:
+        """ 已请求取消更新时抛出UpdateCancelled """
+
+        if self.cancelEvent.is_set():
+            raise UpdateCancelled('update cancelled')
+
+        return
+
+    def prefetch(self) -> bool:
+        """ 后台预下载，以低优先级下载更新路径中的全部更新包或分块，不修改程序目录。
+        下载的更新包与分块保留在本地，应用程序下次启动更新时只需合并；预下载失败不影响之后的更新。
+
+        :return: 预下载成功返回True
+        """
+
+        self.__lower_priority()
+        if self.config.backgroundRateLimit > 0:
+            self.limiter = throttle.RateLimiter(self.config.backgroundRateLimit, self.config.rateLimitHours)
+
+        exit_code = self.config.exitCode
+        with open(self.config.prefetchPidPath, 'w') as fp:
+            fp.write(str(os.getpid()))
+        try:
+            if len(self.getUpdateVersions()) == 0:
+                return True
+
+            update_plan = self.planUpdate()
+            if update_plan[0].get('chunkManifest'):
+                self.__chunk_updater().prefetch(update_plan[0]['chunkManifest'], self.__base_chunk_manifest())
+            else:
+                for step in update_plan:
+                    self.__fetch(step['version'], step['package'])
+            log('预下载完成.')
+            return True
+        except SystemExit:
+            # 下载失败时不修改退出码，应用程序启动时正常更新
+            self.config.writeConfigFile('update', 'exitCode', exit_code)
+            log('预下载失败.')
+            return False
+        except (urllib3.exceptions.HTTPError, OSError) as e:
+            log('预下载失败: {}.'.format(e))
+            return False
+        finally:
+            if os.path.exists(self.config.prefetchPidPath):
+                os.remove(self.config.prefetchPidPath)
+
+    def __lower_priority(self) -> None:
+        """ 降低当前进程的CPU及IO优先级，不影响应用程序运行 """
+
+        process = psutil.Process()
+        try:
+            process.nice(getattr(psutil, 'IDLE_PRIORITY_CLASS', 19))
+            if hasattr(psutil, 'IOPRIO_CLASS_IDLE'):  # linux
+                process.ionice(psutil.IOPRIO_CLASS_IDLE)
+            elif hasattr(psutil, 'IOPRIO_VERYLOW'):   # windows
+                process.ionice(psutil.IOPRIO_VERYLOW)
+        except (psutil.Error, OSError) as e:
+            print('lower priority error, reason: {}!'.format(e))
+
+        return
+
+    def __stop_prefetch(self) -> None:
+        """ 结束正在运行的后台预下载进程 """
+
+        if not os.path.exists(self.config.prefetchPidPath):
             return
 
-        # 3）根据更新列表逐一操作
-        for i in range(0, len(update_version_list)):
-            # 3.1）拉取更新包
-            log('正在拉取更新包:{}.'.format(update_version_list[i]))
-            self.__fetch(update_version_list[i])
-            # 3.2）解压并合并更新包
-            log('正在合并{}更新包.'.format(update_version_list[i]))
-            self.__patch(update_version_list[i])
-            log('版本{}更新成功.'.format(update_version_list[i]))
-
-        # 更新成功
-        self.config.writeConfigFile('update', 'exitCode', '0')
+        try:
+            with open(self.config.prefetchPidPath, 'r') as fp:
+                pid = int(fp.read().strip() or 0)
+            # 进程号可能已被其它程序复用，只结束与当前程序同名的进程
+            if pid != os.getpid() and psutil.pid_exists(pid) \
+                    and psutil.Process(pid).name() == psutil.Process().name():
+                log('正在结束后台预下载进程: {}.'.format(pid))
+                process = psutil.Process(pid)
+                process.terminate()
+                process.wait(5)
+        except (ValueError, psutil.Error, OSError) as e:
+            print('stop prefetch error, reason: {}!'.format(e))
+
+        if os.path.exists(self.config.prefetchPidPath):
+            os.remove(self.config.prefetchPidPath)
+
+        return
+
+    def __apply_plan(self, update_plan: list) -> None:
+        """ 根据更新路径逐一操作，合并第N步的同时在后台拉取第N+1步的更新包，合并严格按版本顺序进行
+
+        :param update_plan: 更新步骤列表
+        """
+
+        cancelled = False  # 是否由本方法请求停止后台下载
+        try:
+            with ThreadPoolExecutor(max_workers=1) as downloader:
+                fetching = downloader.submit(self.fetchStep, update_plan[0])
+                try:
+                    for i in range(0, len(update_plan)):
+                        # 等待当前更新包拉取完成，并开始拉取下一更新包
+                        fetching.result()
+                        if i + 1 < len(update_plan):
+                            fetching = downloader.submit(self.fetchStep, update_plan[i + 1])
+                        self.patchStep(update_plan[i])
+                except BaseException:
+                    # 合并失败时通知后台下载在下一个数据块处停止，退出线程池时无需等待下一更新包下载完成
+                    cancelled = not self.cancelEvent.is_set()
+                    self.cancel()
+                    raise
+        finally:
+            if cancelled:
+                self.cancelEvent.clear()
+
+        return
+
+    @property
+    def installPath(self) -> str:
+        """ 更新操作的目标目录，分阶段安装时为暂存目录，否则为程序目录 """
+        return self.stagingPath if self.stagingPath is not None else self.config.programPath
+
+    def rollback(self) -> bool:
+        """ 回滚至分阶段安装保留的上一版本快照，无需访问网络
+
+        :return: 是否回滚成功
+        """
+
+        snapshots = os.listdir(self.config.snapshotPath) if os.path.exists(self.config.snapshotPath) else []
+        if len(snapshots) == 0:
+            log('没有可回滚的版本快照.')
+            return False
+
+        snapshot = os.path.join(self.config.snapshotPath, snapshots[0])
+        version = snapshots[0][len(self.config.programName):]
+        program_path = os.path.abspath(self.config.programPath)
+        log('正在回滚至{}版本.'.format(version))
+
+        if self.__can_swap_dir():  # 程序目录整体重命名交换
+            os.rename(program_path, program_path + '.rollback')
+            os.rename(snapshot, program_path)
+            shutil.rmtree(program_path + '.rollback')
+        else:  # 逐个文件原子替换
+            self.__commit_tree(snapshot, program_path)
+            shutil.rmtree(snapshot)
+
+        self.config.writeConfigFile('program', 'version', version)
+        log('已回滚至{}版本.'.format(version))
+
+        return True
+
+    def __can_swap_dir(self) -> bool:
+        """ 判断程序目录能否整体重命名交换：当前工作目录与配置文件均不在程序目录中时才可以
+
+        :return: 是否可以整体交换
+        """
+
+        program_path = os.path.join(os.path.abspath(self.config.programPath), '')
+        for path in (os.getcwd(), os.path.dirname(os.path.abspath(self.config.configFilePath))):
+            if os.path.join(os.path.abspath(path), '').startswith(program_path):
+                return False
+
+        return True
+
+    def __stage(self) -> str:
+        """ 以硬链接方式建立暂存目录，未变化的文件不产生数据拷贝。
+        可以整体交换时暂存目录包含程序目录全部文件，否则不包含忽略文件。
+
+        :return: 暂存目录
+        """
+
+        staging = os.path.abspath(self.config.programPath) + '.staging'
+        if os.path.exists(staging):
+            shutil.rmtree(staging)
+
+        ignore = None if self.__can_swap_dir() else self.config.ignoreFiles
+        util.link_tree(self.config.programPath, staging, ignore)
+        log('已建立暂存目录: {}.'.format(staging))
+
+        return staging
+
+    def __swap(self, previous_version: str) -> None:
+        """ 切换至暂存目录，原版本保留为快照，只保留最近一个快照
+
+        :param previous_version: 更新前的版本号
+        """
+
+        program_path = os.path.abspath(self.config.programPath)
+        if os.path.exists(self.config.snapshotPath):
+            shutil.rmtree(self.config.snapshotPath)
+        os.makedirs(self.config.snapshotPath)
+        snapshot = os.path.join(self.config.snapshotPath, self.config.programName + previous_version)
+
+        if self.__can_swap_dir():  # 程序目录整体重命名交换
+            os.rename(program_path, snapshot)
+            os.rename(self.stagingPath, program_path)
+        else:  # 原版本硬链接为快照，然后逐个文件原子替换
+            util.link_tree(program_path, snapshot, self.config.ignoreFiles)
+            self.__commit_tree(self.stagingPath, program_path)
+            shutil.rmtree(self.stagingPath)
+
+        self.stagingPath = None
+        log('已切换至新版本，{}版本快照: {}.'.format(previous_version, snapshot))
+
+        return
+
+    def __commit_tree(self, source: str, program_path: str) -> None:
+        """ 将source目录中的文件逐个以硬链接原子替换至程序目录，并删除source中不存在的非忽略文件
+
+        :param source: 暂存目录或快照目录
+        :param program_path: 程序目录
+        """
+
+        paths = set()
+        for root, dirs, files in os.walk(source):
+            rel_root = os.path.relpath(root, source)
+            os.makedirs(os.path.join(program_path, rel_root), exist_ok=True)
+            for file in files:
+                target = os.path.normpath(os.path.join(program_path, rel_root, file))
+                util.link_file(os.path.join(root, file), target + '.tmp')
+                os.replace(target + '.tmp', target)
+                paths.add(target)
+
+        for root, dirs, files in os.walk(program_path):
+            dirs[:] = [item for item in dirs if item not in self.config.ignoreFiles]
+            for file in files:
+                target = os.path.normpath(os.path.join(root, file))
+                if file not in self.config.ignoreFiles and target not in paths:
+                    os.remove(target)
+
+        # 删除source中不存在的空目录
+        for root, dirs, files in os.walk(program_path, topdown=False):
+            rel_root = os.path.relpath(root, program_path)
+            if rel_root == '.' or any(item in self.config.ignoreFiles for item in rel_root.split(os.sep)):
+                continue
+            if not os.listdir(root) and not os.path.isdir(os.path.join(source, rel_root)):
+                os.rmdir(root)
+
         return
 
     def loadUrl(self) -> list:
-        """ 从文件服务器加载数据, 从中爬取软件名称，提取版本号
+        """ 从文件服务器加载数据, 优先读取发布目录索引文件index.json，
+        服务器未提供索引文件时再从目录页面中爬取软件名称，提取版本号
 
         :return: 版本号列表
         """
@@ -155,25 +490,236 @@ class Update:
                     # 提取版本号 eg: "app_name1.0" -> "1.0"
                     self.update.updateVersionList.append(curr_version[len(self.update.config.programName):])
 
-        # 加载软件目录,借助正则表达式提取版本号, 返回版本号数组
+        self.updateVersionList = []  # 清空版本号列表
+        self.releaseIndex = None
+
+        # 距上次检查不足最短检查间隔时，直接使用本地缓存，不访问文件服务器
+        cache = self.__read_cache()
+        if cache is not None and 0 <= time.time() - cache['checkTime'] < self.config.checkInterval:
+            log('距上次检查更新不足{}秒，使用本地缓存版本列表.'.format(self.config.checkInterval))
+            return self.__use_cache(cache)
+
+        # 文件服务器过载时暂停检查，退避期间使用本地缓存
+        if cache is not None and time.time() < cache.get('backoffUntil', 0):
+            log('文件服务器繁忙，{}后再检查更新.'.format(
+                time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(cache['backoffUntil']))))
+            return self.__use_cache(cache)
+
+        # 随机等待，避免大量客户端同时启动时集中访问文件服务器，同一进程只等待一次
+        check.check_jitter(self.config)
+
         try:
-            http = urllib3.PoolManager()
-            request = http.request('GET', self.config.serverUrl)  # 通过url访问下载目录
+            # 读取索引文件，索引文件与目录页面均以gzip传输，存在本地缓存时发送条件请求
+            source = INDEX_FILE
+            request = self.__request_listing(source, cache)
+            if request.status == 200:
+                self.releaseIndex = self.__parse_index(request.data)
+
+            # 只有服务器没有索引文件(404)或索引文件无效时，才加载软件目录并借助正则表达式提取版本号；
+            # 索引文件请求返回5xx/429时服务器已过载，不再请求最重的目录页面
+            if request.status == 404 or (request.status == 200 and self.releaseIndex is None):
+                source = ''
+                request = self.__request_listing(source, cache)
         except urllib3.exceptions.HTTPError as e:
-            print('load url {} error, reason: {} !'.format(self.config.serverUrl, e.reason))
+            print('load url {} error, reason: {} !'.format(self.config.serverUrl, e))
             self.config.writeConfigFile('update', 'exitCode', '2')
             sys.exit(2)  # http错误，网络错误
 
-        self.updateVersionList = []  # 清空版本号列表
+        # 5xx/429时指数退避，不再立即退出
+        if request.status == 429 or request.status >= 500:
+            check.write_backoff(self.config, cache, request.status, request.headers.get('Retry-After', ''))
+            return self.__use_cache(cache)
 
-        parser = UpdateHTMLParser(update=self)
-        parser.feed(request.data.decode('utf-8'))  # 解析版本号
+        if source == INDEX_FILE and request.status not in (200, 304):
+            print('load url {} error, code: {} !'.format(self.config.serverUrl + INDEX_FILE, request.status))
+            self.config.writeConfigFile('update', 'exitCode', '2')
+            sys.exit(2)  # http错误，eg: 403
+
+        if request.status == 304:  # 版本列表未变化，使用本地缓存，无需解析
+            log('版本列表未变化，使用本地缓存版本列表.')
+            self.releaseIndex = cache['index']
+            self.updateVersionList = list(cache['versions'])
+        elif self.releaseIndex is not None:
+            self.updateVersionList = [item['version'] for item in self.releaseIndex['versions']]
+        else:
+            parser = UpdateHTMLParser(update=self)
+            parser.feed(request.data.decode('utf-8'))  # 解析版本号
 
         # 将版本号从大到小排序
         self.updateVersionList.sort(key=util.cmp_to_key(compare_version))
 
+        # 保存版本列表及缓存校验信息
+        self.__write_cache(source, request, cache)
+
+        # 按灰度发布比例过滤版本
+        self.__apply_rollout()
+
+        return self.updateVersionList
+
+    def __use_cache(self, cache: dict) -> list:
+        """ 使用本地缓存的版本列表
+
+        :param cache: 本地缓存信息，为None或没有成功检查过时版本列表为空
+        :return: 版本号列表
+        """
+
+        self.releaseIndex = cache.get('index') if cache is not None else None
+        self.updateVersionList = list(cache.get('versions', [])) if cache is not None else []
+        self.__apply_rollout()
+
         return self.updateVersionList
 
+    def __apply_rollout(self) -> None:
+        """ 按索引文件中各版本的灰度发布比例(rollout)过滤版本。
+        根据本机标识与版本号计算固定的分桶(0~99)，分桶小于rollout时才更新该版本；
+        第一个不更新的版本之后的版本也不更新，保证增量更新路径连续。
+        """
+
+        if self.releaseIndex is None:
+            return
+
+        allowed, held = planner.rollout_versions(self.releaseIndex, self.config.version)
+        if held is not None:
+            log('版本{}灰度发布中({}%)，本机暂不更新.'.format(held['version'], held['rollout']))
+
+        versions = set(item['version'] for item in allowed)
+        self.releaseIndex = dict(self.releaseIndex, versions=allowed)
+        self.updateVersionList = [version for version in self.updateVersionList if version in versions]
+
+        return
+
+    def __request_listing(self, source: str, cache: dict) -> urllib3.HTTPResponse:
+        """ 请求版本列表，只重试网络错误，不按状态码重试
+
+        :param source: 请求的资源, INDEX_FILE或空字符串(目录页面)
+        :param cache: 本地缓存信息
+        :return: 版本列表响应
+        """
+
+        return self.http.request('GET', self.config.serverUrl + source, headers=self.__listing_headers(cache, source),
+                                 retries=self.listingRetries)
+
+    def __listing_headers(self, cache: dict, source: str) -> dict:
+        """ 构造版本列表请求头，本地缓存来自同一地址时附加条件请求头
+
+        :param cache: 本地缓存信息
+        :param source: 请求的资源, INDEX_FILE或空字符串(目录页面)
+        :return: 请求头
+        """
+
+        headers = urllib3.make_headers(accept_encoding=True)
+        if cache is not None and cache['source'] == source:
+            if cache.get('etag'):
+                headers['If-None-Match'] = cache['etag']
+            if cache.get('lastModified'):
+                headers['If-Modified-Since'] = cache['lastModified']
+
+        return headers
+
+    def __read_cache(self) -> dict:
+        """ 读取本地版本列表缓存
+
+        :return: 缓存信息，缓存不存在、无效或文件服务器地址已变化时返回None
+        """
+        return check.read_cache(self.config)
+
+    def __write_cache(self, source: str, response: urllib3.HTTPResponse, cache: dict) -> None:
+        """ 保存本地版本列表缓存
+
+        :param source: 请求的资源, INDEX_FILE或空字符串(目录页面)
+        :param response: 版本列表响应
+        :param cache: 原本地缓存信息，响应为304时沿用其中的校验信息
+        """
+
+        previous = cache if response.status == 304 else {}
+        check.write_cache(self.config, source, response.headers.get('ETag', previous.get('etag')),
+                          response.headers.get('Last-Modified', previous.get('lastModified')),
+                          self.updateVersionList, self.releaseIndex)
+
+        return
+
+    def __parse_index(self, data: bytes) -> dict:
+        """ 解析索引文件内容
+
+        :param data: 索引文件内容
+        :return: 索引信息，内容不是有效的索引文件时返回None
+        """
+
+        try:
+            index = json.loads(data.decode('utf-8'))
+        except ValueError:
+            log('索引文件{}格式错误, 改为解析目录页面.'.format(INDEX_FILE))
+            return None
+
+        if not isinstance(index, dict) or not isinstance(index.get('versions'), list):
+            return None
+
+        return index
+
+    def __find_package(self, update_version: str, package_file: str) -> dict:
+        """ 在索引文件中查找更新包信息
+
+        :param update_version: 更新版本号
+        :param package_file: 更新包相对发布目录的路径
+        :return: 更新包信息，未找到时返回None
+        """
+
+        if self.releaseIndex is None:
+            return None
+
+        for item in self.releaseIndex['versions']:
+            if item['version'] != update_version:
+                continue
+            for package in item.get('packages', []):
+                if package['file'] == package_file:
+                    return package
+
+        return None
+
+    def planUpdate(self) -> list:
+        """ 规划更新路径。存在索引文件时，将增量更新包与全量更新包视为以下载量为权重的边，
+        选择从当前版本到最新版本下载量最小的路径；否则按更新列表逐一更新。
+        需要先调用getUpdateVersions获取更新列表。
+
+        :return: 更新步骤列表，每一步为{'version': 版本号, 'package': 更新包信息}
+        """
+
+        update_plan = None
+        if self.releaseIndex is not None and self.config.chunkUpdate and len(self.updateVersionList) > 0:
+            latest = [item for item in self.releaseIndex['versions'] if item['version'] == self.updateVersionList[-1]][0]
+            if latest.get('chunkManifest'):
+                log('启用分块更新: {} -> {}.'.format(self.config.version, latest['version']))
+                return [{'version': latest['version'], 'package': None, 'chunkManifest': latest['chunkManifest']}]
+
+        if self.releaseIndex is not None:
+            update_plan = planner.plan_update(self.releaseIndex, self.config.version)
+            if update_plan is None:
+                log('索引文件中没有可达最新版本的更新路径，改为逐一更新.')
+
+        if update_plan is None:
+            update_plan = [{'version': version, 'package': self.__find_package(version, self.__package_file(version))}
+                           for version in self.updateVersionList]
+
+        log('更新路径: {}, 预计下载: {}字节.'.format(
+            ' -> '.join([self.config.version] + [step['version'] for step in update_plan]),
+            planner.plan_size(update_plan)))
+
+        return update_plan
+
+    def __package_file(self, update_version: str, package: dict = None) -> str:
+        """ 获取更新包相对发布目录的路径
+
+        :param update_version: 更新版本号
+        :param package: 索引文件中的更新包信息，为None时使用默认更新包
+        :return: 更新包路径，eg: App2.0/App2.0.zip
+        """
+
+        if package is not None:
+            return package['file']
+
+        fn = self.config.programName + update_version  # 含有版本号的文件名称
+        return fn + '/' + fn + '.zip'
+
     def getUpdateVersions(self) -> list:
         """ 获取更新列表
 
@@ -196,28 +742,26 @@ class Update:
 
         return update_version_list
 
-    def __fetch(self, update_version: str) -> None:
-        """ 根据文件名称到指定下载地址下载更新补丁
+    def __fetch(self, update_version: str, package: dict = None) -> None:
+        """ 根据文件名称到指定下载地址下载更新补丁。
+        下载内容先写入.part文件，中断后再次下载时通过HTTP Range请求断点续传，下载完成后重命名为zip文件。
 
         :param update_version: 更新版本号
+        :param package: 索引文件中的更新包信息，为None时下载默认更新包
         """
 
-        def schedule(block_num: int, bs: int, size: int) -> int:
-            """ hook函数，用于统计并显示下载进度。
+        def schedule(received: int, size: int) -> int:
+            """ 统计并显示下载进度。
 
-            :param block_num: 已经下载的数据块
-            :param bs: 数据块大小
+            :param received: 已经下载的字节数
             :param size: 远程文件大小
             :return: 当前下载进度
             """
 
             # 下载进度计算
-            percent = 100 * block_num * bs / size
-            if percent > 100:
-                percent = 100
+            percent = 100 if size <= 0 else min(100, int(100 * received / size))
 
-            # TODO LOG 处理进度
-            UPDATE_SIGNAL.progress.emit(percent)
+            self.events.emit(events.PROGRESS, percent)
 
             return percent
 
@@ -225,77 +769,592 @@ class Update:
         self.config.refresh()
 
         # 设置下载信息
-        fn = self.config.programName + update_version  # 含有版本号的文件名称
-        download_url = self.config.serverUrl + fn + '/' + fn + '.zip'  # 文件下载地址
+        download_url = self.config.serverUrl + self.__package_file(update_version, package)  # 文件下载地址
+        package_file = os.path.basename(self.__package_file(update_version, package))  # 更新包文件
+        part_file = package_file + '.part'  # 下载中的临时文件
+        validator_file = part_file + '.validator'  # .part文件对应的ETag或Last-Modified，续传时校验服务器文件未变化
+
+        # 上次已经完整下载的更新包无需重复下载
+        if os.path.exists(package_file):
+            log('更新包{}已存在，跳过下载.'.format(package_file))
+            return
+
+        # 优先从局域网缓存获取，校验通过后无需访问文件服务器
+        if self.__fetch_lan(update_version, package, package_file):
+            return
 
-        # 下载文件，下载过程中使用hook处理函数schedule处理结果
+        log('正在拉取更新包:{}.'.format(update_version))
+        offset = os.path.getsize(part_file) if os.path.exists(part_file) else 0
+        validator = self.__read_validator(validator_file) if offset > 0 else ''
+        if offset > 0 and not validator:  # 无法确认服务器文件未变化，不能续传
+            log('更新包{}缺少续传校验信息，重新下载.'.format(package_file))
+            offset = 0
+        # If-Range: 服务器文件已变化(重新发布)时返回200完整内容，不会将旧的.part与新内容拼接
+        headers = {'Range': 'bytes={}-'.format(offset), 'If-Range': validator} if offset > 0 else {}
+
+        # 下载文件，下载过程中使用schedule处理进度
         try:
-            urllib.request.urlretrieve(download_url, filename=fn+'.zip', reporthook=schedule)
-        except urllib.error.HTTPError as e:
-            # TODO 日志处理
-            print('fetch {} version error, reason: {}, code: {}!'
-                  .format(update_version, e.reason, e.code))
+            response = self.http.request('GET', download_url, headers=headers, preload_content=False)
+            if response.status == 206 and self.__content_range(response)[0] != offset:
+                # 代理等返回的范围与请求不一致时不能拼接，丢弃.part文件重新下载
+                log('更新包{}续传范围错误(Content-Range: {})，重新下载.'.format(
+                    package_file, response.headers.get('Content-Range')))
+                response.release_conn()
+                offset = 0
+                response = self.http.request('GET', download_url, preload_content=False)
+            try:
+                # 416表示.part文件已经完整下载
+                if response.status == 416 and response.headers.get('Content-Range') == 'bytes */{}'.format(offset):
+                    pass
+                elif response.status >= 400:
+                    # TODO 日志处理
+                    print('fetch {} version error, reason: {}, code: {}!'
+                          .format(update_version, response.reason, response.status))
+                    self.config.writeConfigFile('update', 'exitCode', '3')
+                    sys.exit(3)  # 发布包错误，访问不到
+                else:
+                    if response.status != 206:  # 服务器不支持断点续传或文件已变化，重新下载
+                        offset = 0
+                        self.__write_validator(validator_file, response)
+                    else:
+                        log('断点续传更新包{}, 起始位置: {}.'.format(package_file, offset))
+                    size = self.__content_range(response)[1] if response.status == 206 else None
+                    if size is None:
+                        size = offset + int(response.headers.get('Content-Length', 0))
+                    received = offset
+                    with open(part_file, 'ab' if offset > 0 else 'wb') as fp:
+                        for block in response.stream(FETCH_BLOCK_SIZE):
+                            fp.write(block)
+                            received += len(block)
+                            schedule(received, size)
+                            self.limiter.consume(len(block))
+                            self.checkCancelled()
+            finally:
+                response.release_conn()
+        except (urllib3.exceptions.HTTPError, OSError) as e:
+            # 已下载部分保留在.part文件中，下次启动更新时续传
+            print('fetch {} version error, reason: {}!'.format(update_version, e))
             self.config.writeConfigFile('update', 'exitCode', '3')
-            sys.exit(3)  # 发布包错误，访问不到 || 网络错误
+            sys.exit(3)  # 发布包错误，网络错误
+
+        # 索引文件记录了更新包摘要值时，校验下载完成的更新包
+        if package is not None and package.get('digest'):
+            if not util.check_digest(part_file, package['digest'], package.get('digestAlgorithm', 'md5')):
+                log('更新包{}校验失败，已删除.'.format(package_file))
+                os.remove(part_file)
+                if os.path.exists(validator_file):
+                    os.remove(validator_file)
+                self.config.writeConfigFile('update', 'exitCode', '3')
+                sys.exit(3)  # 发布包错误，校验失败
+
+        os.replace(part_file, package_file)
+        if os.path.exists(validator_file):
+            os.remove(validator_file)
+        self.__share_lan(package, package_file)
 
         return
 
-    def __patch(self, update_version: str) -> None:
+    @staticmethod
+    def __content_range(response: urllib3.HTTPResponse) -> tuple:
+        """ 解析206响应的Content-Range, eg: bytes 500-1333/1334 -> (500, 1334)
+
+        :param response: 更新包响应
+        :return: (起始位置, 文件总大小)，无法解析时起始位置为None，总大小未知(*)时为None
+        """
+
+        match = re.match(r'bytes (\d+)-\d+/(\d+|\*)$', response.headers.get('Content-Range', '').strip())
+        if match is None:
+            return None, None
+
+        return int(match.group(1)), int(match.group(2)) if match.group(2) != '*' else None
+
+    @staticmethod
+    def __read_validator(validator_file: str) -> str:
+        """ 读取.part文件对应的续传校验信息
+
+        :param validator_file: 续传校验信息文件
+        :return: ETag或Last-Modified，不存在时返回空字符串
+        """
+
+        try:
+            with open(validator_file, 'r', encoding='utf-8') as fp:
+                return fp.read().strip()
+        except OSError:
+            return ''
+
+    @staticmethod
+    def __write_validator(validator_file: str, response: urllib3.HTTPResponse) -> None:
+        """ 开始下载时保存续传校验信息，优先使用强ETag，弱ETag不能用于If-Range，此时使用Last-Modified
+
+        :param validator_file: 续传校验信息文件
+        :param response: 更新包响应
+        """
+
+        etag = response.headers.get('ETag', '')
+        validator = etag if etag and not etag.startswith('W/') else response.headers.get('Last-Modified', '')
+        if validator:
+            with open(validator_file, 'w', encoding='utf-8') as fp:
+                fp.write(validator)
+        elif os.path.exists(validator_file):
+            os.remove(validator_file)
+
+        return
+
+    def __fetch_lan(self, update_version: str, package: dict, package_file: str) -> bool:
+        """ 从局域网缓存服务器或广播发现的节点下载更新包，下载后校验索引文件中的摘要值，
+        局域网内的节点不可信，校验失败时尝试下一来源，全部失败时由调用方从文件服务器下载。
+
+        :param update_version: 更新版本号
+        :param package: 索引文件中的更新包信息
+        :param package_file: 更新包文件
+        :return: 获取成功返回True
+        """
+
+        if not self.config.lanEnabled or package is None or not package.get('digest'):
+            return False
+
+        algorithm = package.get('digestAlgorithm', 'md5')
+        urls = []
+        if self.config.lanCacheUrl:
+            urls.append(self.config.lanCacheUrl + self.__package_file(update_version, package))
+        if self.config.lanDiscovery:
+            try:
+                urls.extend(lancache.discover(algorithm, package['digest'], address=self.config.lanBroadcast,
+                                              port=self.config.lanPort, timeout=self.config.lanTimeout))
+            except OSError as e:
+                print('lan discover error, reason: {}!'.format(e))
+
+        lan_file = package_file + '.lan'
+        for url in urls:
+            log('正在从局域网拉取更新包:{}.'.format(url))
+            try:
+                response = self.http.request('GET', url, preload_content=False, retries=False,
+                                             timeout=urllib3.Timeout(connect=self.config.lanTimeout,
+                                                                     read=self.config.readTimeout))
+                try:
+                    if response.status != 200:
+                        continue
+                    hasher = util.new_hasher(algorithm)
+                    with open(lan_file, 'wb') as fp:
+                        for block in response.stream(FETCH_BLOCK_SIZE):
+                            hasher.update(block)
+                            fp.write(block)
+                finally:
+                    response.release_conn()
+            except (urllib3.exceptions.HTTPError, OSError) as e:
+                print('fetch {} from lan error, reason: {}!'.format(url, e))
+                continue
+
+            if hasher.hexdigest() == package['digest']:
+                os.replace(lan_file, package_file)
+                self.__share_lan(package, package_file)
+                return True
+            log('局域网更新包{}校验失败，已忽略.'.format(url))
+
+        if os.path.exists(lan_file):
+            os.remove(lan_file)
+
+        return False
+
+    def __share_lan(self, package: dict, package_file: str) -> None:
+        """ 将校验通过的更新包保存至本机共享目录，供局域网内其它节点下载
+
+        :param package: 索引文件中的更新包信息
+        :param package_file: 更新包文件
+        """
+
+        if not self.config.lanEnabled or package is None or not package.get('digest'):
+            return
+
+        try:
+            lancache.store_package(self.config.lanStorePath, package_file, package.get('digestAlgorithm', 'md5'),
+                                   package['digest'], keep=self.config.lanStoreSize)
+        except OSError as e:
+            print('share package {} error, reason: {}!'.format(package_file, e))
+
+        return
+
+    def __patch(self, update_version: str, package: dict = None) -> None:
         """ 解压并合并文件
 
         :param update_version: 更新的版本号
+        :param package: 索引文件中的更新包信息，为None时使用默认更新包
         """
 
-        # 判断补丁更新目录是否存在，如果不存在，就创建
-        if not os.path.exists(self.config.patchPath):
-            os.makedirs(self.config.patchPath)
+        package_file = os.path.basename(self.__package_file(update_version, package))  # 更新包文件
 
-        # 1）解压更新包
-        util.unzip(self.config.programName + update_version + '.zip', self.config.patchPath)
+        try:
+            if self.config.streamMerge or self.stagingPath is not None:
+                # 分阶段安装时暂存目录与程序目录共享硬链接，只能使用写入临时文件再替换的流式合并
+                # 直接从更新包中读取版本文件与补丁，新增文件直接写入程序目录，无需解压至补丁目录
+                with zipfile.ZipFile(package_file, 'r') as z_file:
+                    version_info = json.loads(z_file.read('version').decode('utf-8'))
+                    log('{}版本文件信息: {}'.format(update_version, version_info))
+
+                    # 判断是否需要启用增量更新，全量更新需要先清空程序文件夹
+                    if not version_info['incUpdateFlag']:
+                        self.__remove_files()
+
+                    # 完整文件地址相对更新包所在目录
+                    full_url = self.config.serverUrl + posixpath.dirname(self.__package_file(update_version, package))
+                    self.__merge_zip(z_file, version_info, full_url.rstrip('/') + '/')
+            else:
+                # 判断补丁更新目录是否存在，如果不存在，就创建
+                if not os.path.exists(self.config.patchPath):
+                    os.makedirs(self.config.patchPath)
+
+                # 1）解压更新包
+                util.unzip(package_file, self.config.patchPath)
+
+                # 2）解析version文件
+                version_info = util.read_json(os.path.join(self.config.patchPath, 'version'))
+                log('{}版本文件信息: {}'.format(update_version, version_info))
+
+                # 3）判断是否需要启用增量更新，然后执行更新操作， 增量更新需要先清空程序文件夹
+                if not version_info['incUpdateFlag']:  # 启用全量更新
+                    self.__remove_files()  # 清除应用程序文件夹
+
+                # 增量更新，合并新版本
+                self.__merge()
+        except zipfile.BadZipFile as e:
+            # 更新包损坏，eg: 没有索引文件摘要值时续传拼接了不同内容，删除后下次更新重新下载
+            log('更新包{}损坏: {}，已删除.'.format(package_file, e))
+            os.remove(package_file)
+            self.config.writeConfigFile('update', 'exitCode', '3')
+            sys.exit(3)  # 发布包错误，更新包损坏
 
-        # 2）解析version文件
-        version_info = util.read_json(os.path.join(self.config.patchPath, 'version'))
-        log('{}版本文件信息: {}'.format(update_version, version_info))
+        # 4）更新配置文件，设置新版本号，分阶段安装时切换完成后再设置
+        if self.stagingPath is None:
+            self.config.writeConfigFile('program', 'version', update_version)
 
-        # 3）判断是否需要启用增量更新，然后执行更新操作， 增量更新需要先清空程序文件夹
-        if not version_info['incUpdateFlag']:  # 启用全量更新
-            self.__remove_files()  # 清除应用程序文件夹
+        # 5）删除tmp文件夹及压缩包
+        if os.path.exists(self.config.patchPath):
+            shutil.rmtree(self.config.patchPath)
+        if os.path.exists(package_file):
+            os.remove(package_file)
 
-        # 增量更新，合并新版本
-        self.__merge()
+        return
 
-        # 4）更新配置文件，设置新版本号
-        self.config.writeConfigFile('program', 'version', update_version)
+    def __chunk_patch(self, update_version: str, manifest_file: str) -> None:
+        """ 根据分块描述文件更新，只下载本地不存在的分块
 
-        # 5）删除tmp文件夹及压缩包
-        shutil.rmtree(self.config.patchPath)
-        if os.path.exists(self.config.programName + update_version + '.zip'):
-            os.remove(self.config.programName + update_version + '.zip')
+        :param update_version: 更新的版本号
+        :param manifest_file: 分块描述文件相对文件服务器根目录的路径
+        """
+
+        try:
+            self.__chunk_updater().update(manifest_file, self.__base_chunk_manifest())
+        except (urllib3.exceptions.HTTPError, OSError) as e:
+            # 已下载的分块保留在分块缓存目录中，下次更新时复用
+            print('chunk update {} version error, reason: {}!'.format(update_version, e))
+            self.config.writeConfigFile('update', 'exitCode', '3')
+            sys.exit(3)  # 发布包错误，网络错误
+
+        # 更新配置文件，设置新版本号，分阶段安装时切换完成后再设置
+        if self.stagingPath is None:
+            self.config.writeConfigFile('program', 'version', update_version)
 
         return
 
+    def __chunk_updater(self) -> chunkstore.ChunkUpdater:
+        """ 创建分块更新对象，共用连接池与限速对象 """
+
+        return chunkstore.ChunkUpdater(self.http, self.config.serverUrl, self.installPath,
+                                       self.config.chunkCachePath, self.config.ignoreFiles,
+                                       log=log, progress=lambda percent: self.events.emit(events.PROGRESS, percent),
+                                       limiter=self.limiter, manifest_path=self.config.chunkManifestPath)
+
+    def __base_chunk_manifest(self) -> str:
+        """ 获取索引文件中已安装版本的分块描述文件路径，本地没有保存分块描述文件时使用
+
+        :return: 分块描述文件路径，未记录时返回None
+        """
+
+        for item in self.releaseIndex['versions'] if self.releaseIndex is not None else []:
+            if item['version'] == self.config.version:
+                return item.get('chunkManifest')
+
+        return None
+
     def __merge(self) -> None:
-        """ 合并文件 """
+        """ 合并文件，stream_merge = 0时使用：解压后只校验补丁与新增文件的摘要值，
+        不校验旧版本文件(sourceDigest)与合并结果(targetDigest)，也不会在文件无法合并时单独下载完整文件(fullFile)
+        """
 
         version_info = util.read_json(os.path.join(self.config.patchPath, 'version'))
+        algorithm = version_info.get('digestAlgorithm', 'md5')  # 旧版本描述文件未记录算法，默认为md5
 
         # 迭代版本文件
         # 其中files和file为关键字，由version版本文件约束，此处为硬编码
         for file in version_info['files']:
-            # 1）TODO 校验MD5
+            # 1）校验补丁或新增文件摘要值
+            self.__check_digest(file, algorithm)
 
             # 2）合并（新增）文件
-            if file['patch']:  # 打补丁
-                bsdiff4.file_patch(os.path.join(self.config.programPath, file['path']),
-                                   os.path.join(self.config.programPath, file['path']),
+            if file['patch'] and file.get('engine', delta.BSDIFF_ENGINE) != delta.BSDIFF_ENGINE:  # 写入临时文件后替换
+                fp = os.path.join(self.installPath, file['path'])
+                delta.file_patch(fp, fp + '.tmp', os.path.join(self.config.patchPath, file['patchFile']),
+                                 engine=file['engine'])
+                os.replace(fp + '.tmp', fp)
+            elif file['patch']:  # 打补丁
+                bsdiff4.file_patch(os.path.join(self.installPath, file['path']),
+                                   os.path.join(self.installPath, file['path']),
                                    os.path.join(self.config.patchPath, file['patchFile']))
             else:  # 新增(拷贝)文件
                 if not os.path.isdir(os.path.join(self.config.patchPath, file['path'])):
                     shutil.copyfile(os.path.join(self.config.patchPath, file['path']),
-                                    os.path.join(self.config.programPath, file['path']))
+                                    os.path.join(self.installPath, file['path']))
                 else:
                     shutil.copytree(os.path.join(self.config.patchPath, file['path']),
-                                    os.path.join(self.config.programPath, file['path']))
+                                    os.path.join(self.installPath, file['path']))
+
+        return
+
+    def __merge_zip(self, z_file: zipfile.ZipFile, version_info: dict, full_url: str = None) -> None:
+        """ 直接从更新包中流式读取补丁与新增文件并合并，读取时同步校验摘要值。
+        使用线程池并发处理各文件，结果先写入临时文件，全部成功后再统一替换，任一文件失败时删除全部临时文件。
+
+        :param z_file: 更新包
+        :param version_info: 版本文件信息
+        :param full_url: 完整文件下载地址前缀，补丁文件校验失败时据此单独下载该文件
+        """
+
+        algorithm = version_info.get('digestAlgorithm', 'md5')  # 旧版本描述文件未记录算法，默认为md5
+        members = z_file.namelist()
+        files = version_info['files']
+
+        # 1）并发生成临时文件，每完成一个文件更新一次进度
+        staged = []  # [(临时文件, 目标文件)]
+        with ThreadPoolExecutor(max_workers=self.config.workers) as executor:
+            futures = [executor.submit(self.__apply_file, z_file, members, file, algorithm, full_url) for file in files]
+            try:
+                for i, future in enumerate(as_completed(futures)):
+                    staged.extend(future.result())
+                    self.events.emit(events.PROGRESS, int(100 * (i + 1) / len(files)))
+                    self.checkCancelled()
+            except (OSError, zipfile.BadZipFile, UpdateCancelled) as e:
+                for future in futures:
+                    future.cancel()
+                wait(futures)
+                staged = []
+                for future in futures:
+                    if not future.cancelled() and future.exception() is None:
+                        staged.extend(future.result())
+                for tmp, target in staged:
+                    os.remove(tmp)
+                if isinstance(e, UpdateCancelled):  # 取消时程序目录保持不变
+                    raise
+                log('合并文件失败: {}.'.format(e))
+                self.config.writeConfigFile('update', 'exitCode', '3')
+                sys.exit(3)  # 发布包错误，校验失败
+
+        # 2）全部文件处理成功后统一替换
+        for tmp, target in staged:
+            os.replace(tmp, target)
+
+        return
+
+    def __apply_file(self, z_file: zipfile.ZipFile, members: list, file: dict, algorithm: str,
+                     full_url: str = None) -> list:
+        """ 处理版本文件中的一个文件，结果写入临时文件。该方法在线程池中执行。
+        补丁文件在同一次读取中依次校验旧版本文件、补丁与补丁结果的摘要值，
+        任一校验失败且版本文件记录了完整文件时，只单独下载该文件的完整新版本。
+
+        :param z_file: 更新包
+        :param members: 更新包中的文件名称列表
+        :param file: 版本文件中的文件信息
+        :param algorithm: 摘要算法名称
+        :param full_url: 完整文件下载地址前缀
+        :return: [(临时文件, 目标文件)]
+        """
+
+        self.checkCancelled()
+        digest = file.get('digest', file.get('md5'))  # 兼容旧版本描述文件的md5字段
+        target = os.path.join(self.installPath, file['path'])
+
+        if file['patch']:  # 打补丁, 补丁结果写入临时文件
+            try:
+                self.__apply_patch(z_file, file, target, algorithm, digest)
+            except (OSError, ValueError, zipfile.BadZipFile) as e:  # 本地文件被修改、缺失或补丁损坏
+                if not file.get('fullFile') or full_url is None:
+                    raise IOError(str(e))
+                log('文件{}无法合并({})，下载完整文件.'.format(file['path'], e))
+                self.__fetch_file(full_url + file['fullFile'], target + '.tmp', algorithm, file.get('targetDigest'))
+            return [(target + '.tmp', target)]
+
+        if zip_member(file['path']) in members:  # 新增(拷贝)文件, 边读取边校验
+            return [self.__extract_member(z_file, zip_member(file['path']), target,
+                                          util.new_hasher(algorithm) if digest is not None else None, digest)]
+
+        # 新增(拷贝)目录
+        staged = []
+        prefix = zip_member(file['path']) + '/'
+        try:
+            for member in members:
+                if member.startswith(prefix) and not member.endswith('/'):
+                    staged.append(self.__extract_member(z_file, member, os.path.join(target, member[len(prefix):])))
+        except OSError:
+            for tmp, _ in staged:
+                os.remove(tmp)
+            raise
+
+        return staged
+
+    def __apply_patch(self, z_file: zipfile.ZipFile, file: dict, target: str, algorithm: str, digest: str) -> None:
+        """ 读取补丁与旧版本文件并合并至临时文件，读取与合并时同步校验摘要值
+
+        :param z_file: 更新包
+        :param file: 版本文件中的文件信息
+        :param target: 目标文件路径
+        :param algorithm: 摘要算法名称
+        :param digest: 补丁摘要值
+        """
+
+        engine = file.get('engine', delta.BSDIFF_ENGINE)
+        if engine != delta.BSDIFF_ENGINE:  # 分窗口补丁或完整文件，流式合并
+            self.__apply_stream_patch(z_file, file, target, algorithm, digest, engine)
+            return
+
+        def check(name: str, data: bytes, expected: str) -> None:
+            """ 校验数据摘要值，未记录摘要值时跳过 """
+            if expected is not None and util.new_hasher(algorithm, data).hexdigest() != expected:
+                raise IOError('file {} digest mismatch, algorithm: {}'.format(name, algorithm))
+
+        patch = z_file.read(zip_member(file['patchFile']))
+        check(file['patchFile'], patch, digest)
+        with open(target, 'rb') as fp:
+            source = fp.read()
+        check(file['path'], source, file.get('sourceDigest'))
+        data = bsdiff4.patch(source, patch)
+        check(file['path'] + '(patched)', data, file.get('targetDigest'))
+        with open(target + '.tmp', 'wb') as fp:
+            fp.write(data)
+
+        return
+
+    def __apply_stream_patch(self, z_file: zipfile.ZipFile, file: dict, target: str, algorithm: str,
+                             digest: str, engine: str) -> None:
+        """ 顺序读取补丁并合并至临时文件，合并时同步计算补丁与结果的摘要值，内存占用与文件大小无关。
+        完整文件引擎不需要旧版本文件，本地文件缺失或被修改时同样可以更新。
+        旧版本文件只在合并时读取一次，补丁引用的部分被修改时结果摘要值(targetDigest)必然不一致，因此不再预先校验sourceDigest；
+        只有未记录targetDigest的版本文件才预先校验旧版本文件。
+
+        :param z_file: 更新包
+        :param file: 版本文件中的文件信息
+        :param target: 目标文件路径
+        :param algorithm: 摘要算法名称
+        :param digest: 补丁摘要值
+        :param engine: 差分引擎名称
+        """
+
+        need_source = engine != delta.FULL_ENGINE
+        if need_source and file.get('targetDigest') is None and file.get('sourceDigest') is not None \
+                and not util.check_digest(target, file['sourceDigest'], algorithm):
+            raise IOError('file {} digest mismatch, algorithm: {}'.format(file['path'], algorithm))
+
+        patch_hasher, target_hasher = util.new_hasher(algorithm), util.new_hasher(algorithm)
+        os.makedirs(os.path.dirname(os.path.abspath(target)), exist_ok=True)
+        old_fp = open(target, 'rb') if need_source else None
+        try:
+            with z_file.open(zip_member(file['patchFile']), 'r') as patch_fp, open(target + '.tmp', 'wb') as new_fp:
+                delta.apply_stream(engine, old_fp, patch_fp, new_fp, patch_hasher, target_hasher)
+            for name, hasher, expected in ((file['patchFile'], patch_hasher, digest),
+                                           (file['path'] + '(patched)', target_hasher, file.get('targetDigest'))):
+                if expected is not None and hasher.hexdigest() != expected:
+                    raise IOError('file {} digest mismatch, algorithm: {}'.format(name, algorithm))
+        except (OSError, ValueError):
+            if os.path.exists(target + '.tmp'):
+                os.remove(target + '.tmp')
+            raise
+        finally:
+            if old_fp is not None:
+                old_fp.close()
+
+        return
+
+    def __fetch_file(self, url: str, target: str, algorithm: str, digest: str = None) -> None:
+        """ 下载单个完整文件至临时文件，写入时同步校验摘要值
+
+        :param url: 文件下载地址
+        :param target: 临时文件路径
+        :param algorithm: 摘要算法名称
+        :param digest: 文件摘要值
+        """
+
+        hasher = util.new_hasher(algorithm)
+        try:
+            response = self.http.request('GET', url, preload_content=False)
+            try:
+                if response.status != 200:
+                    raise IOError('fetch {} error, code: {}'.format(url, response.status))
+                os.makedirs(os.path.dirname(os.path.abspath(target)), exist_ok=True)
+                with open(target, 'wb') as fp:
+                    for block in response.stream(FETCH_BLOCK_SIZE):
+                        hasher.update(block)
+                        fp.write(block)
+                        self.limiter.consume(len(block))
+                        self.checkCancelled()
+            finally:
+                response.release_conn()
+        except urllib3.exceptions.HTTPError as e:
+            raise IOError('fetch {} error, reason: {}'.format(url, e))
+        except UpdateCancelled:
+            os.remove(target)
+            raise
+
+        if digest is not None and hasher.hexdigest() != digest:
+            os.remove(target)
+            raise IOError('file {} digest mismatch, algorithm: {}'.format(url, algorithm))
+
+        return
+
+    def __extract_member(self, z_file: zipfile.ZipFile, member: str, target: str,
+                         hasher=None, digest: str = None) -> tuple:
+        """ 将更新包中的文件流式写入目标位置的临时文件
+
+        :param z_file: 更新包
+        :param member: 更新包中的文件名称
+        :param target: 目标文件路径
+        :param hasher: 摘要对象，不为None时写入过程中计算摘要值并与digest比较
+        :param digest: 文件摘要值
+        :return: (临时文件, 目标文件)
+        """
+
+        os.makedirs(os.path.dirname(os.path.abspath(target)), exist_ok=True)
+        with z_file.open(member, 'r') as src, open(target + '.tmp', 'wb') as dst:
+            util.copy_stream(src, dst, hasher)
+
+        if hasher is not None and hasher.hexdigest() != digest:
+            os.remove(target + '.tmp')
+            raise IOError('file {} digest mismatch, algorithm: {}'.format(member, hasher.name))
+
+        return target + '.tmp', target
+
+    def __digest_error(self, name: str, algorithm: str) -> None:
+        """ 文件校验失败，终止更新
+
+        :param name: 校验失败的文件
+        :param algorithm: 摘要算法名称
+        """
+
+        log('文件{}校验失败, 算法: {}.'.format(name, algorithm))
+        self.config.writeConfigFile('update', 'exitCode', '3')
+        sys.exit(3)  # 发布包错误，校验失败
+
+    def __check_digest(self, file: dict, algorithm: str) -> None:
+        """ 使用版本描述文件记录的摘要算法校验补丁文件或新增文件
+
+        :param file: 版本描述文件中的文件信息
+        :param algorithm: 摘要算法名称
+        """
+
+        digest = file.get('digest', file.get('md5'))  # 兼容旧版本描述文件的md5字段
+        fp = os.path.join(self.config.patchPath, file['patchFile'] if file['patch'] else file['path'])
+        if digest is None or os.path.isdir(fp):
+            return
+
+        if not util.check_digest(fp, digest, algorithm):
+            self.__digest_error(fp, algorithm)
 
         return
 
@@ -304,7 +1363,7 @@ class Update:
 
         ignores = self.config.ignoreFiles
 
-        for root, dirs, files in os.walk(self.config.programPath):
+        for root, dirs, files in os.walk(self.installPath):
             ignores = ignores + [os.path.join(root, item) for item in ignores]
             dir_list = [os.path.join(root, item) for item in dirs]
 
@@ -318,7 +1377,7 @@ class Update:
             for file in files:
                 if file in self.config.ignoreFiles:
                     continue
-                os.remove(os.path.join(self.config.programPath, file))
+                os.remove(os.path.join(self.installPath, file))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,176 @@
+""" 无界面更新程序，不依赖Qt，适用于服务器及批量静默部署。
+标准输出每行为一个JSON事件，供部署工具解析；控制台日志输出至标准错误。
+eg: python update_cli.py --config ./update.ini --kill
+{"event": "currVersion", "version": "1.0", "time": 1792310400.0}
+{"event": "progress", "percent": 50, "time": 1792310401.2}
+{"event": "step", "version": "2.0", "time": 1792310402.5}
+{"event": "completed", "success": true, "version": "2.0", "exitCode": 0, "time": 1792310402.6}
+:author: 闻煜
+:time: 2026/10/18
+"""
+import argparse
+import json
+import sys
+import threading
+import time
+import events
+from events import UPDATE_EVENTS
+from logger import log, flush_log
+
+
+def main() -> None:
+    """ 主函数, 程序从该函数运行 """
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--config', type=str, default='update.ini', help=u'配置文件路径')
+    parser.add_argument('--check', action='store_true', help=u'只检查更新，输出需要更新的版本列表')
+    parser.add_argument('--kill', action='store_true', help=u'更新前结束应用程序')
+    parser.add_argument('--prefetch', action='store_true', help=u'后台低优先级预下载')
+    parser.add_argument('--rollback', action='store_true', help=u'回滚至上一版本快照')
+    args = parser.parse_args()
+
+    # 标准输出只输出JSON事件，print及控制台日志改为输出至标准错误
+    writer = JsonEventWriter(sys.stdout)
+    sys.stdout = sys.stderr
+    writer.subscribe(UPDATE_EVENTS)
+
+    exit_code = 0
+    try:
+        exit_code = run(args, writer)
+    except SystemExit as e:
+        exit_code = e.code if isinstance(e.code, int) else 1
+    except BaseException as e:
+        log(e)
+        exit_code = 1
+
+    writer.write('completed', success=exit_code == 0, version=writer.version, exitCode=exit_code)
+    sys.exit(exit_code)
+
+
+def run(args: argparse.Namespace, writer: 'JsonEventWriter') -> int:
+    """ 根据命令行参数检查更新、更新、预下载或回滚
+
+    :param args: 命令行参数
+    :param writer: JSON事件输出对象
+    :return: 退出码
+    """
+
+    # 只检查更新时优先使用快速检查，不加载更新所需的模块
+    if args.check:
+        import check
+        from config import UpdaterConfigInfo
+        config = UpdaterConfigInfo(args.config)
+        writer.version = config.version
+        versions = check.check_update(config)
+        if versions is None:
+            from update import Update
+            versions = Update(args.config).getUpdateVersions()
+        writer.write('versions', versions=versions)
+        return 0
+
+    import util
+    from update import Update
+    update = Update(args.config)
+    writer.version = update.config.version
+    UPDATE_EVENTS.emit(events.CURR_VERSION, update.config.version)
+
+    if args.rollback or args.prefetch:
+        success = update.rollback() if args.rollback else update.prefetch()
+        update.config.refresh()
+        writer.version = update.config.version  # 回滚后为快照版本
+        return 0 if success else 1
+
+    new_versions = update.getUpdateVersions()
+    if len(new_versions) == 0:
+        log('没有新版本需要更新!')
+        return 0
+    UPDATE_EVENTS.emit(events.NEW_VERSION, new_versions[-1])
+
+    if args.kill:
+        pids = util.kill_process(update.config.application)  # 终止应用程序
+        log('终止进程, PID: {}, NAME: {}.'.format(pids, update.config.application))
+
+    update.run()
+    update.config.refresh()
+    writer.version = update.config.version
+
+    return int(update.config.exitCode or 0)
+
+
+class JsonEventWriter:
+    """ JSON事件输出类，订阅更新事件，每个事件输出为一行JSON """
+
+    def __init__(self, stream) -> None:
+        """ 构造函数
+
+        :param stream: 输出流, eg: sys.stdout
+        """
+
+        self.stream = stream
+        self.version = None    # 当前版本号，每完成一个版本后更新
+        self.percent = None    # 上次输出的进度，进度未变化时不输出
+        self.lock = threading.Lock()
+
+        return
+
+    def subscribe(self, update_events: events.UpdateEvents) -> None:
+        """ 订阅更新事件
+
+        :param update_events: 更新事件对象
+        """
+
+        update_events.subscribe(events.CURR_VERSION, lambda version: self.write('currVersion', version=version))
+        update_events.subscribe(events.NEW_VERSION, lambda version: self.write('newVersion', version=version))
+        update_events.subscribe(events.PROGRESS, self.__progress)
+        update_events.subscribe(events.STEP, self.__step)
+        update_events.subscribe(events.LOG, self.__log)
+
+        return
+
+    def write(self, event: str, **fields) -> None:
+        """ 输出一行JSON事件。日志由后台线程异步发送，输出其它事件前先等待已记录的日志输出，
+        保证日志位于其所属的进度、版本完成及结束事件之前；日志事件由后台线程输出，不能等待自身。
+
+        :param event: 事件名称
+        :param fields: 事件内容
+        """
+
+        if event != 'log':
+            flush_log()
+
+        line = json.dumps(dict(event=event, **fields, time=time.time()), ensure_ascii=False)
+        with self.lock:
+            self.stream.write(line + '\n')
+            self.stream.flush()
+
+        return
+
+    def __progress(self, percent: int) -> None:
+        """ 输出进度，进度未变化时不输出 """
+
+        if percent != self.percent:
+            self.percent = percent
+            self.write('progress', percent=percent)
+
+        return
+
+    def __step(self, version: str) -> None:
+        """ 输出版本更新完成事件，下一版本的进度从0开始 """
+
+        self.version = version
+        self.percent = None
+        self.write('step', version=version)
+
+        return
+
+    def __log(self, info: str) -> None:
+        """ 输出日志，合并发送的多条日志拆分为多个事件 """
+
+        for line in info.split('\n'):
+            self.write('log', message=line)
+
+        return
+
+
+if __name__ == '__main__':
+    main()
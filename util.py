@@ -7,10 +7,9 @@ import json
 import os
 import shutil
 from typing import Callable
+import uuid
 import zipfile
 
-import psutil
-
 
 def get_file_size(fp: str) -> int:
     """ 获取文件大小，以字节byte为单位
@@ -22,30 +21,95 @@ def get_file_size(fp: str) -> int:
     return file_size
 
 
+# 支持的摘要算法, md5为默认算法，兼容旧版本描述文件
+DIGEST_ALGORITHMS = ('md5', 'sha1', 'sha256', 'blake2b')
+
+# 流式计算摘要时的读取缓冲区大小, 默认1MB
+DIGEST_BUFFER_SIZE = 1024 * 1024
+
+
+def new_hasher(algorithm: str = 'md5', data: bytes = b''):
+    """ 根据算法名称创建摘要对象。
+
+    :param algorithm: 摘要算法名称，取值见DIGEST_ALGORITHMS
+    :param data: 初始数据
+    :return: hashlib摘要对象
+    """
+    if algorithm not in DIGEST_ALGORITHMS:
+        raise ValueError('unsupported digest algorithm: {}'.format(algorithm))
+    return hashlib.new(algorithm, data)
+
+
+def copy_stream(src, dst, hasher=None, buffer_size: int = DIGEST_BUFFER_SIZE) -> int:
+    """ 使用固定大小缓冲区将src流复制到dst流，复制过程中可同步计算摘要值。
+
+    :param src: 源文件对象
+    :param dst: 目标文件对象
+    :param hasher: 摘要对象，为None时不计算摘要
+    :param buffer_size: 读取缓冲区大小
+    :return: 复制的字节数
+    """
+    size = 0
+    while True:
+        data = src.read(buffer_size)
+        if not data:
+            break
+        if hasher is not None:
+            hasher.update(data)
+        dst.write(data)
+        size += len(data)
+    return size
+
+
+def get_file_digest(file: str, algorithm: str = 'md5', buffer_size: int = DIGEST_BUFFER_SIZE) -> str:
+    """ 流式获取文件摘要值。
+    使用预分配的固定大小缓冲区循环readinto读取文件，内存占用与文件大小无关。
+
+    :param file: 文件路径
+    :param algorithm: 摘要算法名称，取值见DIGEST_ALGORITHMS
+    :param buffer_size: 读取缓冲区大小
+    :return: 文件摘要值(十六进制)
+    """
+    hasher = new_hasher(algorithm)
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+    with open(file, 'rb', buffering=0) as fp:
+        while True:
+            size = fp.readinto(buffer)
+            if not size:
+                break
+            hasher.update(view[:size])
+    return hasher.hexdigest()
+
+
 def get_file_md5(file: str) -> str:
     """ 获取文件MD5值。
 
     :param file: 文件路径
     :return: 文件MD5值
     """
-    with open(file, 'rb') as fp:
-        data = fp.read()
-    md5 = hashlib.md5(data).hexdigest()  # TODO 大文件md5
-    return md5
+    return get_file_digest(file, 'md5')
+
+
+def check_digest(file: str, file_digest: str, algorithm: str = 'md5') -> bool:
+    """ 校验文件file的摘要值与给定file_digest是否一致。
+
+    :param file: 校验文件路径
+    :param file_digest: 校验文件给定摘要值
+    :param algorithm: 摘要算法名称
+    :return: 校验结果，一致返回True，不一致返回False
+    """
+    return get_file_digest(file, algorithm) == file_digest
 
 
-def check_md5(file: str, file_md5: str) -> str:
+def check_md5(file: str, file_md5: str) -> bool:
     """ 校验文件file的MD5值与给定file_md5是否一致。
 
     :param file: 校验文件路径
     :param file_md5: 校验文件给定MD5值
     :return: 校验结果，一致返回True，不一致返回False
     """
-    md5 = get_file_md5(file)
-    if file_md5 == md5:
-        return True
-    else:
-        return False
+    return check_digest(file, file_md5, 'md5')
 
 
 def save_json(json_dict: {}, file: str) -> None:
@@ -86,6 +150,39 @@ def recurse_dir(path: str, func: Callable[..., None], ignore_dirs: list = []) ->
             func(file)
 
 
+def link_file(src: str, dst: str) -> None:
+    """ 创建硬链接，文件系统不支持硬链接时拷贝文件。
+
+    :param src: 源文件
+    :param dst: 目标文件
+    :return:
+    """
+    if os.path.exists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def link_tree(src: str, dst: str, ignore: list = None) -> None:
+    """ 以硬链接方式复制目录src至dst，不产生数据拷贝。
+
+    :param src: 源目录
+    :param dst: 目标目录
+    :param ignore: 忽略的文件或目录名称
+    :return:
+    """
+    ignore = ignore or []
+    for root, dirs, files in os.walk(src):
+        dirs[:] = [item for item in dirs if item not in ignore]
+        target_root = os.path.join(dst, os.path.relpath(root, src))
+        os.makedirs(target_root, exist_ok=True)
+        for file in files:
+            if file not in ignore:
+                link_file(os.path.join(root, file), os.path.join(target_root, file))
+
+
 def unzip(file: str, extract_dir: str) -> bool:
     """ 解压文件file(含路径)全部至目录extract_dir
 
@@ -131,6 +228,8 @@ def kill_process(process_name: str) -> list:
     :return: 关闭的进程PID列表
     """
 
+    import psutil  # 只在结束进程时导入，检查更新时不加载
+
     pids = psutil.process_iter()  # 所有进程信息
     pid_list = []
 
@@ -143,6 +242,72 @@ def kill_process(process_name: str) -> list:
     return pid_list
 
 
+def get_machine_id() -> str:
+    """ 获取稳定的本机标识，重装更新程序后保持不变。
+    windows读取注册表MachineGuid，linux读取/etc/machine-id，均不可用时使用网卡MAC地址。
+
+    :return: 本机标识
+    """
+    try:
+        import winreg
+        with winreg.OpenKey(winreg.HKEY_LOCAL_MACHINE, r'SOFTWARE\Microsoft\Cryptography', 0,
+                            winreg.KEY_READ | winreg.KEY_WOW64_64KEY) as key:
+            return winreg.QueryValueEx(key, 'MachineGuid')[0]
+    except (ImportError, OSError):
+        pass
+
+    for path in ('/etc/machine-id', '/var/lib/dbus/machine-id'):
+        try:
+            with open(path, 'r') as f:
+                machine_id = f.read().strip()
+            if machine_id:
+                return machine_id
+        except OSError:
+            pass
+
+    return '{:012x}'.format(uuid.getnode())
+
+
+def rollout_bucket(machine_id: str, version: str) -> int:
+    """ 根据本机标识与版本号计算灰度发布分桶，同一台机器同一版本的分桶固定，不同版本的分桶相互独立。
+
+    :param machine_id: 本机标识
+    :param version: 版本号
+    :return: 分桶编号，0~99
+    """
+    digest = hashlib.sha256('{}:{}'.format(machine_id, version).encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') % 100
+
+
+def compare_version(version1: str, version2: str) -> int:
+    """ 比较版本号version1和version2。
+    版本号由一个或多个修订号组成，各修订号由一个 '.' 连接。
+    每个修订号由多位数字组成，可能包含前导零 。每个版本号至少包含一个字符。
+    修订号从左到右编号，下标从 0 开始，最左边的修订号下标为 0 ，下一个修订号下标为 1 ，以此类推。
+    例如，2.5.33 和 0.1 都是有效的版本号。
+    比较版本号时，请按从左到右的顺序依次比较它们的修订号。
+    比较修订号时，只需比较 忽略任何前导零后的整数值 。
+    也就是说，修订号 1 和修订号 001 相等 。
+    如果版本号没有指定某个下标处的修订号，则该修订号视为 0 。
+    例如，版本 1.0 小于版本 1.1 ，因为它们下标为 0 的修订号相同，而下标为 1 的修订号分别为 0 和 1 ，0 < 1 。
+
+    :param version1: 版本号1
+    :param version2: 版本号2
+    :return: 如果version1>version2, 返回1, 如果version1<version2, 返回-1, 除此之外返回0
+    """
+    arr1 = version1.split('.')
+    arr2 = version2.split('.')
+    max_length = max(len(arr1), len(arr2))
+    for i in range(0, max_length):
+        num1 = int(arr1[i]) if i < len(arr1) else 0
+        num2 = int(arr2[i]) if i < len(arr2) else 0
+        if num1 == num2:
+            continue
+        return 1 if num1 > num2 else -1
+
+    return 0
+
+
 def cmp_to_key(mycmp):
     """Convert a cmp= function into a key= function"""
 
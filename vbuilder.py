@@ -3,15 +3,41 @@
 :time: 2022/09/27
 """
 import argparse
+import bz2
+import json
+import lzma
+import multiprocessing
 import os.path
 import platform
+import posixpath
+import re
 import time
+import zipfile
+import zlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from filecmp import dircmp
-import bsdiff4
+from chunkstore import ChunkBuilder, CHUNK_MANIFEST
+import delta
 import util
 import shutil
 
 
+FULL_DIR = 'full'  # 完整文件目录名称，位于更新包所在目录
+
+# 更新包压缩算法，按解压开销从小到大排列
+CODECS = {
+    'stored': zipfile.ZIP_STORED,
+    'deflate': zipfile.ZIP_DEFLATED,
+    'bzip2': zipfile.ZIP_BZIP2,
+    'lzma': zipfile.ZIP_LZMA
+}
+CODEC_MIN_GAIN = 0.01  # 压缩收益低于该比例时选择解压开销更小的算法
+CODEC_SAMPLE_SIZE = 4 * 1024 * 1024  # 超过该大小的文件只抽样试压缩，按比例估算压缩后大小
+CODEC_SAMPLE_HEAD = 1024 * 1024  # 抽样时读取的文件头部大小
+CODEC_SAMPLE_STRIDES = 6  # 抽样时在文件头部之后均匀读取的数据块个数
+CODEC_SAMPLE_BLOCK = 512 * 1024  # 抽样数据块大小
+
+
 def main() -> None:
     """ 主函数, 程序从该函数运行 """
 
@@ -44,6 +70,34 @@ def args_parser() -> None:
     parser.add_argument('-d', '--Description', type=str, help=u'版本描述', nargs='?')
     parser.add_argument('-v', '--VersionNumber', type=str, help=u'更新版本号', nargs='?')
     parser.add_argument('-V', '--Version', type=str, help=u'vbuilder版本', nargs='?')
+    parser.add_argument('-a', '--DigestAlgorithm', type=str, help=u'文件摘要算法,默认为md5',
+                        choices=util.DIGEST_ALGORITHMS, default='md5')
+    parser.add_argument('-j', '--jobs', type=int, help=u'并行构建进程数,0为CPU核数,默认为1', default=1)
+    parser.add_argument('-b', '--BaseVersion', type=str, help=u'增量更新基准版本号，一般指旧版本号', nargs='?')
+    parser.add_argument('-I', '--Index', type=str, help=u'生成发布目录索引文件index.json，参数为发布目录', nargs='?')
+    parser.add_argument('-n', '--Name', type=str, help=u'软件名称，生成索引文件时使用', nargs='?')
+    parser.add_argument('-R', '--Rollout', type=str, help=u'版本灰度发布比例(0~100)，生成索引文件时使用，可多次指定',
+                        nargs=2, action='append', metavar=('RolloutVersion', 'Percent'))
+    parser.add_argument('-H', '--History', type=str, help=u'历史版本号及其程序目录，可多次指定，用于生成累积补丁',
+                        nargs=2, action='append', metavar=('HistoryVersion', 'HistoryPath'))
+    parser.add_argument('-C', '--ChunkStore', type=str, help=u'分块存储目录，指定时同时生成分块描述文件chunks.json',
+                        nargs='?')
+    parser.add_argument('-K', '--Keep', type=int, help=u'只为最近K个历史版本生成累积补丁，默认全部', default=0)
+    parser.add_argument('-c', '--Cache', type=str, help=u'文件摘要缓存文件，为空时不使用缓存，默认为~/.vbuilder_cache',
+                        default=os.path.join(os.path.expanduser('~'), '.vbuilder_cache'))
+    parser.add_argument('-e', '--Engines', type=str, help=u'候选差分引擎，以:区分，默认full:block:bsdiff',
+                        default=':'.join(delta.ENGINES))
+    parser.add_argument('-T', '--TimeBudget', type=float, help=u'单个文件尝试差分引擎的时间预算(秒)，默认10',
+                        default=delta.TIME_BUDGET)
+    parser.add_argument('-L', '--LargeFile', type=int, help=u'大文件阈值(字节)，超过该大小的文件不使用bsdiff，默认256MB',
+                        default=delta.LARGE_FILE_SIZE)
+    parser.add_argument('-W', '--Window', type=int, help=u'大文件差分窗口大小(字节)，默认8MB', default=delta.WINDOW_SIZE)
+    parser.add_argument('-z', '--Codec', type=str, help=u'更新包压缩算法，auto为逐个文件选择压缩后最小的算法，默认auto',
+                        choices=['auto'] + list(CODECS), default='auto')
+    parser.add_argument('-l', '--CompressLevel', type=int, help=u'deflate、bzip2压缩级别，默认9，lzma使用默认预设', choices=range(1, 10),
+                        default=9)
+    parser.add_argument('-F', '--FullFiles', help=u'在补丁目录full子目录中保留补丁文件的完整新版本，供校验失败时单独下载',
+                        action='store_true')
     flag_parser = parser.add_mutually_exclusive_group(required=False)
     flag_parser.add_argument('-f', '--IncUpdateFlag', help=u'开启增量更新', dest='Flag', action='store_true')
     flag_parser.add_argument('-nf', '--No--IncUpdateFlag', help=u'关闭增量更新', dest='Flag', action='store_false')
@@ -56,6 +110,17 @@ def args_parser() -> None:
         print('version:', '1.0')
         return
 
+    # 生成发布目录索引文件
+    if args.Index:
+        if not args.Name:
+            print('usage: vbuilder --Index PublishPath --Name ProgramName')
+            return
+        rollout = {version: int(percent) for version, percent in args.Rollout or []}
+        index_builder = IndexBuilder(args.Index, args.Name, digest_algorithm=args.DigestAlgorithm, rollout=rollout)
+        index_builder.build()
+        index_builder.write()
+        return
+
     # 判断命令行必要参数
     if not args.LeftPath:
         print('usage: vbuilder LeftPath RightPath PatchPath')
@@ -72,20 +137,294 @@ def args_parser() -> None:
         args.IgnoreFiles = args.IgnoreFiles.split(':')
 
     # 根据参数设置vbuilder
+    digest_cache = DigestCache(args.Cache or None, args.DigestAlgorithm)
     builder = VersionBuilder(args.LeftPath, args.RightPath,
                              patch_path=args.PatchPath,
                              inc_update_flag=args.Flag,
-                             ignore=args.IgnoreFiles)
+                             ignore=args.IgnoreFiles,
+                             digest_algorithm=args.DigestAlgorithm,
+                             jobs=args.jobs,
+                             digest_cache=digest_cache)
 
     # 根据可选参数配置信息
     if args.Description:
         builder.description = args.Description
     if args.VersionNumber:
         builder.version = args.VersionNumber
+    if args.BaseVersion:
+        builder.baseVersion = args.BaseVersion
+    builder.engines = tuple(args.Engines.split(':'))
+    if not builder.engines or not set(builder.engines) <= set(delta.ENGINES):
+        print('usage: vbuilder --Engines {}'.format(':'.join(delta.ENGINES)))
+        return
+    builder.timeBudget = args.TimeBudget
+    builder.largeFileSize = args.LargeFile
+    builder.windowSize = args.Window
+    if args.FullFiles:
+        builder.fullPath = os.path.join(args.PatchPath, FULL_DIR)
 
-    # 比对目录并构造
+    # 比对目录并构造，打包更新包
     builder.build()
     builder.write()
+    builder.package(codec=args.Codec, level=args.CompressLevel)
+
+    # 为历史版本生成直接更新到新版本的累积补丁
+    if args.History:
+        build_cumulative(args.History, builder, keep=args.Keep, codec=args.Codec, level=args.CompressLevel)
+
+    # 保存摘要缓存，下次构建时跳过未变化文件的读取
+    digest_cache.save()
+
+    # 将新版本文件分块存入分块存储目录，生成分块描述文件
+    if args.ChunkStore:
+        chunk_builder = ChunkBuilder(args.RightPath, args.PatchPath, args.ChunkStore, ignore=args.IgnoreFiles)
+        chunk_builder.version = builder.version
+        chunk_builder.build()
+        chunk_builder.write()
+
+
+def build_cumulative(history: list, builder: 'VersionBuilder', keep: int = 0, codec: str = 'auto',
+                     level: int = 9) -> list:
+    """ 为最近keep个历史版本分别生成直接更新到新版本的累积补丁，并打包为zip文件。
+    累积补丁目录及更新包放置在补丁目录中，eg: ./Patch/App3.0/App3.0-from1.0.zip，
+    版本描述文件中记录baseVersion，生成索引文件后更新程序即可据此直接从历史版本一步更新到新版本。
+
+    :param history: 历史版本列表，每项为[版本号, 程序目录]
+    :param builder: 新版本构造对象，复用其右侧目录、忽略文件、摘要算法等配置
+    :param keep: 只处理最近keep个历史版本，0表示全部
+    :param codec: 更新包压缩算法
+    :param level: 压缩级别
+    :return: 生成的累积更新包列表
+    """
+
+    # 按版本号从新到旧排序，选取最近keep个历史版本
+    history = sorted(history, key=util.cmp_to_key(lambda a, b: util.compare_version(b[0], a[0])))
+    if keep > 0:
+        history = history[:keep]
+
+    name = os.path.basename(os.path.normpath(builder.patchPath))  # 更新包名称, eg: App3.0
+    packages = []
+    for base_version, base_path in history:
+        print('cumulative: ', base_version, '->', builder.version)
+        patch_path = os.path.join(builder.patchPath, '{}-from{}'.format(name, base_version))
+        cumulative = VersionBuilder(base_path, builder.rightPath, patch_path=patch_path, ignore=builder.ignore,
+                                    inc_update_flag=True, digest_algorithm=builder.digestAlgorithm,
+                                    jobs=builder.jobs, digest_cache=builder.digestCache)
+        cumulative.version = builder.version
+        cumulative.description = builder.description
+        cumulative.baseVersion = base_version
+        cumulative.fullPath = builder.fullPath  # 完整文件只与新版本有关，与主更新包共用
+        cumulative.engines = builder.engines
+        cumulative.timeBudget = builder.timeBudget
+        cumulative.largeFileSize = builder.largeFileSize
+        cumulative.windowSize = builder.windowSize
+        cumulative.build()
+        cumulative.write()
+
+        packages.append(cumulative.package(patch_path + '.zip', codec=codec, level=level))
+
+    return packages
+
+
+def sample_ranges(size: int) -> list:
+    """ 计算试压缩读取的文件范围，小文件读取全部内容，大文件读取头部及均匀分布的若干数据块
+
+    :param size: 文件大小
+    :return: [(偏移, 长度)]
+    """
+    if size <= CODEC_SAMPLE_SIZE:
+        return [(0, size)]
+
+    ranges = [(0, CODEC_SAMPLE_HEAD)]
+    stride = (size - CODEC_SAMPLE_HEAD) // CODEC_SAMPLE_STRIDES
+    for i in range(1, CODEC_SAMPLE_STRIDES + 1):
+        ranges.append((CODEC_SAMPLE_HEAD + stride * i - CODEC_SAMPLE_BLOCK, CODEC_SAMPLE_BLOCK))
+    return ranges
+
+
+def measure_codecs(file: str, codecs: list, level: int = 9) -> dict:
+    """ 流式压缩文件并统计各压缩算法压缩后的大小，只计数不保存压缩结果。
+    超过CODEC_SAMPLE_SIZE的文件只压缩抽样数据，按抽样压缩率估算整个文件压缩后的大小。
+    lzma与zipfile写入时一致使用默认预设，zipfile不支持设置lzma压缩级别，level对lzma不生效。
+
+    :param file: 文件路径
+    :param codecs: 压缩算法名称列表
+    :param level: deflate、bzip2压缩级别
+    :return: {压缩算法: 压缩后大小}
+    """
+    compressors = {}
+    for codec in codecs:
+        if codec == 'deflate':
+            compressors[codec] = zlib.compressobj(level, zlib.DEFLATED, -15)
+        elif codec == 'bzip2':
+            compressors[codec] = bz2.BZ2Compressor(level)
+        elif codec == 'lzma':
+            compressors[codec] = lzma.LZMACompressor(lzma.FORMAT_RAW, filters=[{'id': lzma.FILTER_LZMA1}])
+
+    size = util.get_file_size(file)
+    sizes = {codec: 0 for codec in compressors}
+    sampled = 0
+    with open(file, 'rb') as fp:
+        for offset, length in sample_ranges(size):
+            fp.seek(offset)
+            while length > 0:
+                data = fp.read(min(length, util.DIGEST_BUFFER_SIZE))
+                if not data:
+                    break
+                length -= len(data)
+                sampled += len(data)
+                for codec, compressor in compressors.items():
+                    sizes[codec] += len(compressor.compress(data))
+    for codec, compressor in compressors.items():
+        sizes[codec] += len(compressor.flush())
+        if sampled < size:
+            sizes[codec] = sizes[codec] * size // sampled
+    if 'stored' in codecs:
+        sizes['stored'] = size
+
+    return {codec: sizes[codec] for codec in codecs}
+
+
+def choose_codec(task: dict) -> dict:
+    """ 为更新包中的一个文件选择压缩算法，该函数在进程池中执行。
+    auto时统计全部算法压缩后的大小（大文件为抽样估算值），选择最小者，
+    压缩收益不足CODEC_MIN_GAIN时选择解压开销更小的算法，已压缩的数据因此直接存储。
+
+    :param task: 打包任务，由VersionBuilder.package收集
+    :return: {'arcname': 包内名称, 'codec': 压缩算法, 'sizes': {压缩算法: 压缩后大小}}
+    """
+    codecs = list(CODECS) if task['codec'] == 'auto' else [task['codec']]
+    sizes = measure_codecs(task['file'], codecs, task['level'])
+
+    codec = codecs[0]
+    for item in codecs[1:]:
+        if sizes[item] < sizes[codec] * (1 - CODEC_MIN_GAIN):
+            codec = item
+
+    return {'arcname': task['arcname'], 'codec': codec, 'sizes': sizes}
+
+
+def build_file(task: dict) -> dict:
+    """ 执行单个文件构建任务：计算补丁、拷贝新增文件并计算摘要值。
+    该函数在进程池中执行，参数与返回值均需可序列化。
+
+    :param task: 构建任务，由VersionBuilder.build收集
+    :return: 版本描述文件中的文件信息
+    """
+
+    # 设置文件版本描述信息
+    file = {'patch': task['patch'], 'path': task['path']}
+    rel_fp = task['target']
+
+    if task['patch']:  # 根据新老版本计算补丁文件，判断目录是否存在，如果不存在就创建目录
+        os.makedirs(os.path.dirname(rel_fp), exist_ok=True)
+        file['engine'] = delta.best_diff(task['left'], task['right'], rel_fp, engines=task['engines'],
+                                         time_budget=task['timeBudget'], window_size=task['windowSize'])
+        file['patchFile'] = task['patchFile']
+        file['digest'] = util.get_file_digest(rel_fp, task['digestAlgorithm'])
+        file['sourceDigest'] = task['sourceDigest']
+        file['targetDigest'] = task['targetDigest']
+        if task.get('full'):  # 保留完整新版本文件，更新程序校验失败时单独下载该文件
+            os.makedirs(os.path.dirname(task['full']), exist_ok=True)
+            shutil.copyfile(task['right'], task['full'])
+            file['fullFile'] = task['fullFile']
+    elif os.path.isfile(task['right']):  # 如果是文件
+        # 提取文件至当前目录，判断是否存在，如果不存在就使用makedirs递归创建目录
+        os.makedirs(os.path.dirname(rel_fp), exist_ok=True)
+        file['digest'] = task['digest']
+        shutil.copyfile(task['right'], rel_fp)
+    else:  # 如果是目录，拷贝目录至补丁目录
+        shutil.copytree(task['right'], rel_fp)
+
+    return file
+
+
+class DigestCache:
+    """ 文件摘要缓存类
+    以文件绝对路径为键，记录文件大小、修改时间、inode及摘要值，三者均未变化时直接使用缓存的摘要值，
+    避免重复构建时反复读取未变化的文件。缓存文件采用json格式，不同摘要算法分别记录，格式描述如下：
+    ---------------------------------------->
+    {
+      "md5": {
+        "/release/App2.0/App.dll": [81920, 1663640000000000000, 1234567, "ddd34fsdf2jiojfsdjfsdfj"]
+      }
+    }
+    <----------------------------------------
+    """
+
+    def __init__(self, cache_file: str = None, algorithm: str = 'md5') -> None:
+        """ 构造函数，读取缓存文件
+
+        :param cache_file: 缓存文件路径，为None时只在内存中缓存
+        :param algorithm: 摘要算法
+        """
+
+        self.cacheFile = cache_file
+        self.algorithm = algorithm
+        self.hits = 0    # 缓存命中次数
+        self.misses = 0  # 缓存未命中次数
+        self.cache = {}  # 摘要算法 -> {路径: [大小, 修改时间, inode, 摘要值]}
+
+        if cache_file and os.path.exists(cache_file):
+            try:
+                self.cache = util.read_json(cache_file)
+            except ValueError:  # 缓存文件损坏时重新建立
+                print('digest cache {} is broken, rebuild.'.format(cache_file))
+        self.entries = self.cache.setdefault(algorithm, {})
+
+        return
+
+    def digests(self, paths: list, jobs: int = 1) -> dict:
+        """ 获取一组文件的摘要值，未命中缓存的文件根据jobs串行或使用进程池并行计算
+
+        :param paths: 文件路径列表
+        :param jobs: 并行计算进程数
+        :return: {文件路径: 摘要值}
+        """
+
+        result = {}
+        misses = []  # [(文件路径, 文件状态)]
+        for path in paths:
+            if path in result:
+                continue
+            st = os.stat(path)
+            stat = [st.st_size, st.st_mtime_ns, st.st_ino]
+            entry = self.entries.get(os.path.abspath(path))
+            if entry is not None and entry[:3] == stat:
+                self.hits += 1
+                result[path] = entry[3]
+            else:
+                self.misses += 1
+                result[path] = None
+                misses.append((path, stat))
+
+        if jobs <= 1 or len(misses) <= 1:
+            digests = [util.get_file_digest(path, self.algorithm) for path, _ in misses]
+        else:
+            with ProcessPoolExecutor(max_workers=jobs) as executor:
+                digests = list(executor.map(util.get_file_digest, [path for path, _ in misses],
+                                            [self.algorithm] * len(misses)))
+
+        for (path, stat), digest in zip(misses, digests):
+            result[path] = digest
+            self.entries[os.path.abspath(path)] = stat + [digest]
+
+        return result
+
+    def save(self) -> None:
+        """ 删除已不存在文件的记录后写入缓存文件 """
+
+        if not self.cacheFile:
+            return
+
+        for algorithm in self.cache:
+            self.cache[algorithm] = {path: entry for path, entry in self.cache[algorithm].items()
+                                     if os.path.exists(path)}
+        os.makedirs(os.path.dirname(os.path.abspath(self.cacheFile)), exist_ok=True)
+        util.save_json(self.cache, self.cacheFile + '.tmp')
+        os.replace(self.cacheFile + '.tmp', self.cacheFile)
+
+        return
 
 
 class VersionBuilder:
@@ -98,25 +437,46 @@ class VersionBuilder:
       "description": "文件描述",
       "packageTime": "2022-09-20",
       "incUpdateFlag": true,
+      "baseVersion": "0.9",
+      "digestAlgorithm": "md5",
       "files": [
         {
           "patch": true,
           "path": "./app.exe",
           "patchFile": "./app.exe.patch",
-          "md5": "ddd34fsdf2jiojfsdjfsdfj"
+          "engine": "bsdiff",
+          "digest": "ddd34fsdf2jiojfsdjfsdfj",
+          "sourceDigest": "a1b2c3d4e5f60718293a4b5c",
+          "targetDigest": "0f1e2d3c4b5a69788796a5b4",
+          "fullFile": "full/app.exe",
+          "codec": "deflate",
+          "codecSizes": {"stored": 10240, "deflate": 4096, "bzip2": 4302, "lzma": 4150}
+        },
+        {
+          "patch": true,
+          "path": "./data.bin",
+          "patchFile": "./data.bin.patch",
+          "engine": "full",
+          "digest": "e5f60718293a4b5ca1b2c3d4"
         },
         {
           "patch": false,
           "path": "./update.txt",
-          "md5": "ddd3fsssf2jiojfsdjfs1fj"
+          "digest": "ddd3fsssf2jiojfsdjfs1fj"
         }
       ]
     }
     <----------------------------------------
+    补丁文件的digest为补丁摘要值，sourceDigest、targetDigest分别为旧版本、新版本文件摘要值；
+    fullFile为完整新版本文件相对更新包所在目录的地址，仅在指定-F时记录；
+    engine为生成补丁的差分引擎：bsdiff、block(分窗口差分)或full(完整文件)，构建时选择补丁最小的引擎，
+    未记录时为bsdiff；codec为该文件在更新包中的压缩算法，codecSizes为各压缩算法压缩后的大小，
+    超过4MB的文件为抽样估算值。
     """
 
     def __init__(self, left_path: str, right_path: str, patch_path: str = './tmp',
-                 ignore: list = None, inc_update_flag: bool = True) -> None:
+                 ignore: list = None, inc_update_flag: bool = True, digest_algorithm: str = 'md5',
+                 jobs: int = 1, digest_cache: 'DigestCache' = None) -> None:
         """ 构造函数，初始化成员变量 """
 
         # 读取配置信息
@@ -124,6 +484,8 @@ class VersionBuilder:
         self.rightPath = right_path
         self.patchPath = patch_path
         self.ignore = ignore
+        self.jobs = jobs if jobs > 0 else (os.cpu_count() or 1)  # 并行构建进程数
+        self.digestCache = digest_cache or DigestCache(None, digest_algorithm)  # 文件摘要缓存
 
         # 设置版本描述文件名称，默认为version
         self.versionName = 'version'  # 版本描述文件名称
@@ -133,7 +495,14 @@ class VersionBuilder:
         self.description = ''                    # 版本描述
         self.packageTime = ''                    # 打包时间
         self.incUpdateFlag = inc_update_flag     # 是否启用增量更新，默认启用
+        self.baseVersion = ''                    # 增量更新基准版本号，可选
+        self.digestAlgorithm = digest_algorithm  # 文件摘要算法，默认md5
         self.files = []                          # 文件集合
+        self.fullPath = None                     # 完整文件目录，为None时不保留补丁文件的完整新版本
+        self.engines = delta.ENGINES                # 候选差分引擎
+        self.timeBudget = delta.TIME_BUDGET         # 单个文件尝试差分引擎的时间预算
+        self.largeFileSize = delta.LARGE_FILE_SIZE  # 大文件阈值，超过该大小的文件不使用bsdiff
+        self.windowSize = delta.WINDOW_SIZE         # 大文件差分窗口大小
 
         # 路径分隔符，根据不同系统平台适配不同分隔符
         self.split = '/'
@@ -150,10 +519,15 @@ class VersionBuilder:
         return
 
     def build(self) -> None:
-        """ 根据文件路径生成版本描述文件 """
+        """ 根据文件路径生成版本描述文件
+        先遍历比对目录收集构建任务，再根据jobs串行或使用进程池并行执行，
+        最后按文件路径排序，保证版本描述文件与任务完成顺序无关。
+        """
+
+        tasks = []  # 构建任务列表
 
         def __buildDiff(left: str, right: str, cmp: dircmp, lp: str, rp: str) -> None:
-            """ 根据新旧目录构建版本描述文件
+            """ 根据新旧目录收集构建任务
 
             :param left: 左侧文件路径，一般使用老程序目录
             :param right: 右侧文件路径，一般使用新程序目录
@@ -162,50 +536,39 @@ class VersionBuilder:
             :param rp: 右侧临时对象
             """
 
-            # 处理（新老版本）共同拥有的差异文件
-            for item in cmp.diff_files:
-                print('differ: ', lp + self.split + item)
-                # print(util.get_file_md5(left + self.split + item))
-
-                # 根据新老版本计算补丁文件，放置在文件目录，判断目录是否存在，如果不存在就创建目录
-                fp1 = left + self.split + item
-                fp2 = right + self.split + item
-                rel_fp = os.path.join(self.patchPath, rp + self.split + item + '.patch')  # 目标文件相对路径
-
-                # 设置文件版本描述信息
-                file = {'patch': True, 'path': rp + self.split + item}
-
-                if not os.path.exists(os.path.dirname(rel_fp)):
-                    os.makedirs(os.path.dirname(rel_fp))
-                bsdiff4.file_diff(fp1, fp2, rel_fp)
-
-                file['patchFile'] = rp + self.split + item + '.patch'
-                file['md5'] = util.get_file_md5(rel_fp)
-                self.files.append(file)
+            # 处理（新老版本）共同拥有的文件，比较摘要值后只保留差异文件
+            for item in cmp.common_files:
+                # 根据新老版本计算补丁文件，放置在文件目录
+                tasks.append({
+                    'patch': True,
+                    'path': rp + self.split + item,
+                    'label': 'differ: ' + lp + self.split + item,
+                    'left': left + self.split + item,
+                    'right': right + self.split + item,
+                    'patchFile': rp + self.split + item + '.patch',
+                    'target': os.path.join(self.patchPath, rp + self.split + item + '.patch'),  # 目标文件相对路径
+                    'digestAlgorithm': self.digestAlgorithm
+                })
+                # bsdiff内存占用约为文件大小的9~17倍，大文件只使用其它引擎
+                engines = self.engines
+                if max(os.path.getsize(tasks[-1]['left']), os.path.getsize(tasks[-1]['right'])) > self.largeFileSize:
+                    engines = tuple(item for item in engines if item != delta.BSDIFF_ENGINE) or (delta.BLOCK_ENGINE,)
+                tasks[-1].update({'engines': engines, 'timeBudget': self.timeBudget, 'windowSize': self.windowSize})
+                if self.fullPath:
+                    tasks[-1]['full'] = os.path.join(self.fullPath, rp + self.split + item)
+                    tasks[-1]['fullFile'] = FULL_DIR + '/' + (rp + '/' + item).replace('\\', '/')[2:]
 
             # 处理右侧（新版本）目录独有文件或目录
             for item in cmp.right_only:
-                print('only in right: ', rp + self.split + item)
-
                 # 将fp拷贝至rel_fp, eg: /user/code/app2.0/demo/app.exe -> ./demo/app.exe
-                fp = right + self.split + item   # 源文件路径
-                rel_fp = os.path.join(self.patchPath, rp + self.split + item)  # 目标文件相对路径
-
-                # 设置文件版本描述信息
-                file = {'patch': False, 'path': rp + self.split + item}
-
-                if os.path.isfile(fp):  # 如果是文件
-                    # print(util.get_file_md5(fp))  # 保存md5值
-                    # 提取文件至当前目录，判断是否存在，如果不存在就使用makedirs递归创建目录
-                    if not os.path.exists(os.path.dirname(rel_fp)):
-                        os.makedirs(os.path.dirname(rel_fp))
-                    file['md5'] = util.get_file_md5(fp)
-                    shutil.copyfile(fp, rel_fp)
-                else:  # 如果是目录
-                    # 拷贝目录至补丁目录
-                    shutil.copytree(fp, rel_fp)
-
-                self.files.append(file)
+                tasks.append({
+                    'patch': False,
+                    'path': rp + self.split + item,
+                    'label': 'only in right: ' + rp + self.split + item,
+                    'right': right + self.split + item,
+                    'target': os.path.join(self.patchPath, rp + self.split + item),  # 目标文件相对路径
+                    'digestAlgorithm': self.digestAlgorithm
+                })
 
             # 递归处理子目录，逐一比较
             for key in cmp.subdirs:
@@ -218,12 +581,104 @@ class VersionBuilder:
         print('left base path: ', self.leftPath)
         print('right base path: ', self.rightPath)
 
-        # 目录比对, 结果保存至变量列表
+        # 目录比对, 收集构建任务
         compare = dircmp(self.leftPath, self.rightPath, ignore=self.ignore)
         __buildDiff(self.leftPath, self.rightPath, compare, '.', '.')
 
+        # 使用摘要缓存计算文件摘要值，代替dircmp逐字节比较共同文件
+        paths = []
+        for task in tasks:
+            if task['patch']:
+                paths.extend((task['left'], task['right']))
+            elif os.path.isfile(task['right']):
+                paths.append(task['right'])
+        digests = self.digestCache.digests(paths, jobs=self.jobs)
+        print('digest cache hits: {}, misses: {}.'.format(self.digestCache.hits, self.digestCache.misses))
+        for task in tasks:
+            if task['patch']:
+                task['sourceDigest'] = digests[task['left']]
+                task['targetDigest'] = digests[task['right']]
+            elif task['right'] in digests:
+                task['digest'] = digests[task['right']]
+        tasks = [task for task in tasks if not task['patch'] or task['sourceDigest'] != task['targetDigest']]
+
+        # 执行构建任务, 每完成一个文件输出一次进度
+        files = []
+        total = len(tasks)
+        if self.jobs <= 1 or total <= 1:
+            for task in tasks:
+                files.append(build_file(task))
+                print('[{}/{}] {}'.format(len(files), total, task['label']))
+        else:
+            print('build with {} jobs.'.format(self.jobs))
+            with ProcessPoolExecutor(max_workers=self.jobs) as executor:
+                futures = {executor.submit(build_file, task): task for task in tasks}
+                for future in as_completed(futures):
+                    files.append(future.result())
+                    print('[{}/{}] {}'.format(len(files), total, futures[future]['label']))
+
+        # 按路径排序，保证版本描述文件确定
+        self.files = sorted(files, key=lambda f: f['path'])
+
         return
 
+    def package(self, package_file: str = None, codec: str = 'auto', level: int = 9) -> str:
+        """ 将版本描述文件、补丁及新增文件打包为zip更新包，逐个文件选择压缩算法，
+        并将各压缩算法压缩后的大小记录在版本描述文件中。
+
+        :param package_file: 更新包路径，默认为补丁目录中与补丁目录同名的zip文件，eg: ./Patch/App2.0/App2.0.zip
+        :param codec: 压缩算法，auto为逐个文件选择压缩后最小的算法
+        :param level: deflate、bzip2压缩级别
+        :return: 更新包路径
+        """
+
+        if package_file is None:
+            package_file = os.path.join(self.patchPath, os.path.basename(os.path.normpath(self.patchPath)) + '.zip')
+
+        # 1）收集打包文件，包内名称与更新程序读取时一致，eg: sub/app.dll
+        tasks = []
+        entries = {}  # 包内名称 -> 版本描述文件中的文件信息
+        for file in self.files:
+            member = os.path.join(self.patchPath, file['patchFile'] if file['patch'] else file['path'])
+            arcname = posixpath.normpath(os.path.relpath(member, self.patchPath).replace(os.sep, '/'))
+            members = [(member, arcname)]
+            if os.path.isdir(member):
+                members = [(os.path.join(root, name),
+                            posixpath.normpath(os.path.relpath(os.path.join(root, name), self.patchPath)
+                                               .replace(os.sep, '/')))
+                           for root, _, names in os.walk(member) for name in names]
+            else:
+                entries[arcname] = file
+            tasks.extend({'file': fp, 'arcname': name, 'codec': codec, 'level': level} for fp, name in members)
+
+        # 2）选择压缩算法，记录至版本描述文件
+        if self.jobs <= 1 or len(tasks) <= 1:
+            choices = [choose_codec(task) for task in tasks]
+        else:
+            with ProcessPoolExecutor(max_workers=self.jobs) as executor:
+                choices = list(executor.map(choose_codec, tasks))
+        totals = {}
+        for choice in choices:
+            totals[choice['codec']] = totals.get(choice['codec'], 0) + choice['sizes'][choice['codec']]
+            if choice['arcname'] in entries:
+                entries[choice['arcname']]['codec'] = choice['codec']
+                entries[choice['arcname']]['codecSizes'] = choice['sizes']
+        self.write()
+
+        # 3）写入更新包
+        with zipfile.ZipFile(package_file + '.tmp', 'w') as z_file:
+            z_file.write(os.path.join(self.patchPath, self.versionName), self.versionName,
+                         compress_type=zipfile.ZIP_DEFLATED, compresslevel=level)
+            for task, choice in zip(tasks, choices):
+                z_file.write(task['file'], task['arcname'], compress_type=CODECS[choice['codec']],
+                             compresslevel=level if choice['codec'] in ('deflate', 'bzip2') else None)
+        os.replace(package_file + '.tmp', package_file)
+
+        print('package: ', package_file, util.get_file_size(package_file))
+        print('codecs: ', ', '.join('{} {}'.format(key, value) for key, value in sorted(totals.items())))
+
+        return package_file
+
     def write(self) -> None:
         """ 将版本描述信息写入json文件 """
 
@@ -236,8 +691,11 @@ class VersionBuilder:
             'description': self.description,
             'packageTime': self.packageTime,
             'incUpdateFlag': self.incUpdateFlag,
+            'digestAlgorithm': self.digestAlgorithm,
             'files': self.files
         }
+        if self.baseVersion:
+            version_package['baseVersion'] = self.baseVersion
 
         # 写入文件
         if not os.path.exists(self.patchPath):
@@ -247,5 +705,130 @@ class VersionBuilder:
         return
 
 
+class IndexBuilder:
+    """ 构造发布目录索引文件类
+    索引文件放置在文件服务器发布目录根部，默认文件名称为index.json，
+    更新程序只需请求该文件即可获得全部版本信息，无需解析目录页面。格式描述如下：
+    ---------------------------------------->
+    {
+      "name": "App",
+      "indexTime": "2022-09-20 10:00:00",
+      "versions": [
+        {
+          "version": "2.0",
+          "description": "版本描述",
+          "chunkManifest": "App2.0/chunks.json",
+          "rollout": 20,
+          "packages": [
+            {
+              "file": "App2.0/App2.0.zip",
+              "incUpdateFlag": true,
+              "baseVersion": "1.0",
+              "size": 10240,
+              "digestAlgorithm": "md5",
+              "digest": "ddd34fsdf2jiojfsdjfsdfj"
+            }
+          ]
+        }
+      ]
+    }
+    <----------------------------------------
+    全量更新包的baseVersion为null，未指定baseVersion的增量更新包默认基于上一版本；
+    chunkManifest为分块描述文件路径，仅在版本目录中存在chunks.json时记录；
+    rollout为灰度发布比例(0~100)，小于100时记录，未指定时沿用原索引文件中的比例。
+    """
+
+    def __init__(self, publish_path: str, program_name: str, digest_algorithm: str = 'md5',
+                 rollout: dict = None) -> None:
+        """ 构造函数，初始化成员变量
+
+        :param publish_path: 文件服务器发布目录
+        :param program_name: 软件名称
+        :param digest_algorithm: 更新包摘要算法
+        :param rollout: 各版本灰度发布比例, eg: {'3.1': 20}
+        """
+
+        self.publishPath = publish_path
+        self.programName = program_name
+        self.digestAlgorithm = digest_algorithm
+        self.rollout = rollout or {}   # 灰度发布比例
+        self.indexName = 'index.json'  # 索引文件名称
+        self.versions = []             # 版本信息集合
+
+        return
+
+    def build(self) -> None:
+        """ 扫描发布目录下各版本目录中的zip更新包，读取包内版本描述文件生成索引 """
+
+        versions = {}
+        pattern = re.compile(re.escape(self.programName) + r'(\d+(\.\d+)*)$')
+        for dir_name in sorted(os.listdir(self.publishPath)):
+            matched = pattern.match(dir_name)
+            dir_path = os.path.join(self.publishPath, dir_name)
+            if matched is None or not os.path.isdir(dir_path):
+                continue
+
+            for file_name in sorted(os.listdir(dir_path)):
+                if not file_name.endswith('.zip'):
+                    continue
+                package_file = os.path.join(dir_path, file_name)
+                with zipfile.ZipFile(package_file, 'r') as z_file:
+                    version_info = json.loads(z_file.read('version').decode('utf-8'))
+                print('package: ', package_file)
+
+                inc_update_flag = version_info.get('incUpdateFlag', True)
+                version = versions.setdefault(matched.group(1), {
+                    'version': matched.group(1),
+                    'description': version_info.get('description', ''),
+                    'packages': []
+                })
+                version['packages'].append({
+                    'file': dir_name + '/' + file_name,
+                    'incUpdateFlag': inc_update_flag,
+                    'baseVersion': version_info.get('baseVersion') or None if inc_update_flag else None,
+                    'size': util.get_file_size(package_file),
+                    'digestAlgorithm': self.digestAlgorithm,
+                    'digest': util.get_file_digest(package_file, self.digestAlgorithm)
+                })
+
+        # 按版本号从小到大排序，未指定基准版本号的增量更新包默认基于上一版本
+        self.versions = sorted(versions.values(),
+                               key=util.cmp_to_key(lambda a, b: util.compare_version(a['version'], b['version'])))
+        for version in self.versions:
+            if os.path.exists(os.path.join(self.publishPath, self.programName + version['version'], CHUNK_MANIFEST)):
+                version['chunkManifest'] = self.programName + version['version'] + '/' + CHUNK_MANIFEST
+        # 灰度发布比例，未指定的版本沿用原索引文件中的比例
+        rollout = {}
+        index_file = os.path.join(self.publishPath, self.indexName)
+        if os.path.exists(index_file):
+            rollout = {item['version']: item['rollout'] for item in util.read_json(index_file).get('versions', [])
+                       if 'rollout' in item}
+        rollout.update(self.rollout)
+        for version in self.versions:
+            if rollout.get(version['version'], 100) < 100:
+                version['rollout'] = max(0, rollout[version['version']])
+
+        for i in range(1, len(self.versions)):
+            for package in self.versions[i]['packages']:
+                if package['incUpdateFlag'] and package['baseVersion'] is None:
+                    package['baseVersion'] = self.versions[i - 1]['version']
+
+        return
+
+    def write(self) -> None:
+        """ 将索引信息写入发布目录index.json文件 """
+
+        index = {
+            'name': self.programName,
+            'indexTime': time.strftime("%Y-%m-%d %H:%M:%S", time.localtime()),
+            'versions': self.versions
+        }
+        util.save_json(index, os.path.join(self.publishPath, self.indexName))
+        print('index: ', os.path.join(self.publishPath, self.indexName))
+
+        return
+
+
 if __name__ == '__main__' :
+    multiprocessing.freeze_support()  # pyinstaller打包后进程池需要
     main()